@@ -0,0 +1,141 @@
+# Synthetic label images and specification DOCX files for the benchmark.
+# Every sample carries a serial number, so each upload has its own content hash and
+# is not answered from the result cache unless that is what is being measured.
+import argparse
+import io
+import json
+import os
+import zipfile
+from typing import Dict, List, Tuple
+from xml.sax.saxutils import escape
+
+from PIL import Image, ImageDraw
+
+RECORDINGS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "recordings")
+
+CONTENT_TYPES = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">
+<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>
+<Default Extension="xml" ContentType="application/xml"/>
+<Override PartName="/word/document.xml" ContentType="application/vnd.openxmlformats-officedocument.wordprocessingml.document.main+xml"/>
+<Override PartName="/docProps/core.xml" ContentType="application/vnd.openxmlformats-package.core-properties+xml"/>
+<Override PartName="/docProps/app.xml" ContentType="application/vnd.openxmlformats-officedocument.extended-properties+xml"/>
+</Types>"""
+
+PACKAGE_RELS = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">
+<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="word/document.xml"/>
+<Relationship Id="rId2" Type="http://schemas.openxmlformats.org/package/2006/relationships/metadata/core-properties" Target="docProps/core.xml"/>
+<Relationship Id="rId3" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/extended-properties" Target="docProps/app.xml"/>
+</Relationships>"""
+
+CORE_PROPS = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<cp:coreProperties xmlns:cp="http://schemas.openxmlformats.org/package/2006/metadata/core-properties" xmlns:dc="http://purl.org/dc/elements/1.1/">
+<dc:title>{title}</dc:title>
+</cp:coreProperties>"""
+
+APP_PROPS = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Properties xmlns="http://schemas.openxmlformats.org/officeDocument/2006/extended-properties">
+<Application>Microsoft Office Word</Application>
+</Properties>"""
+
+W_NS = "http://schemas.openxmlformats.org/wordprocessingml/2006/main"
+
+def load_spec() -> Dict:
+    # The recorded docx2json answer doubles as the content of the generated documents
+    with open(os.path.join(RECORDINGS_PATH, "llm", "docx2json.json"), 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def spec_rows(spec: Dict, serial: int) -> Tuple[List[str], List[List[str]]]:
+    paragraphs = [f"標示說明書 #{serial}"]
+    paragraphs += [f"{key}:{value['content']}" for key, value in spec.items() if "content" in value]
+    nutrition = spec["營養標示"]
+    table = [["營養標示", "每份", "每100公克"]]
+    for key, value in nutrition.items():
+        if "content" in value:
+            table.append([key, value["content"], ""])
+        else:
+            table.append([key, value["每份"], value["每100公克 or 每日參考值百分比"]])
+    return paragraphs, table
+
+def make_docx(serial: int, spec: Dict) -> bytes:
+    paragraphs, table = spec_rows(spec, serial)
+
+    def paragraph(text: str) -> str:
+        return f"<w:p><w:r><w:t xml:space=\"preserve\">{escape(text)}</w:t></w:r></w:p>"
+
+    rows = "".join(
+        "<w:tr>" + "".join(f"<w:tc>{paragraph(cell)}</w:tc>" for cell in row) + "</w:tr>"
+        for row in table
+    )
+    document = (
+        f"<?xml version=\"1.0\" encoding=\"UTF-8\" standalone=\"yes\"?>"
+        f"<w:document xmlns:w=\"{W_NS}\"><w:body>"
+        + "".join(paragraph(text) for text in paragraphs)
+        + f"<w:tbl>{rows}</w:tbl>"
+        + "<w:sectPr/></w:body></w:document>"
+    )
+
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as docx:
+        docx.writestr("[Content_Types].xml", CONTENT_TYPES)
+        docx.writestr("_rels/.rels", PACKAGE_RELS)
+        docx.writestr("docProps/core.xml", CORE_PROPS.format(title=f"Label {serial}"))
+        docx.writestr("docProps/app.xml", APP_PROPS)
+        docx.writestr("word/document.xml", document)
+    return buffer.getvalue()
+
+def make_label(serial: int, spec: Dict, width: int = 1200, height: int = 1600) -> bytes:
+    """
+    A label-like PNG: lines of text above a ruled nutrition table, which the table
+    detector has to find. The OCR stand-in answers from recordings, so the text only
+    needs to look like text.
+    """
+    paragraphs, table = spec_rows(spec, serial)
+    image = Image.new("RGB", (width, height), "white")
+    draw = ImageDraw.Draw(image)
+
+    y = 40
+    for text in paragraphs:
+        # The default bitmap font has no CJK glyphs; draw ASCII stand-ins of similar length
+        draw.text((40, y), f"{serial:06d} " + "x" * min(80, len(text) * 2), fill="black")
+        y += 36
+
+    top = y + 40
+    row_height = 44
+    columns = [60, 460, 800, width - 60]
+    bottom = top + row_height * len(table)
+    draw.rectangle([columns[0], top, columns[-1], bottom], outline="black", width=4)
+    for index in range(1, len(table)):
+        draw.line([columns[0], top + index * row_height, columns[-1], top + index * row_height], fill="black", width=2)
+    for x in columns[1:-1]:
+        draw.line([x, top, x, bottom], fill="black", width=2)
+    for index, row in enumerate(table):
+        for column, cell in enumerate(row):
+            draw.text((columns[column] + 12, top + index * row_height + 14), "9" * min(12, len(cell) * 2), fill="black")
+
+    buffer = io.BytesIO()
+    image.save(buffer, "PNG")
+    return buffer.getvalue()
+
+def make_sample(serial: int, spec: Dict) -> Dict:
+    return {
+        "name": f"bench-{serial}",
+        "docx": (f"label_{serial}.docx", make_docx(serial, spec)),
+        "image": (f"label_{serial}.png", make_label(serial, spec))
+    }
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Write a synthetic corpus of label images and spec documents")
+    parser.add_argument('--out', default="bench/corpus")
+    parser.add_argument('-n', '--count', type=int, default=10)
+    args = parser.parse_args()
+
+    os.makedirs(args.out, exist_ok=True)
+    spec = load_spec()
+    for serial in range(args.count):
+        sample = make_sample(serial, spec)
+        for filename, content in (sample["docx"], sample["image"]):
+            with open(os.path.join(args.out, filename), 'wb') as f:
+                f.write(content)
+    print(f"Wrote {args.count} samples to {args.out}")
@@ -0,0 +1,261 @@
+# Local stand-ins for the external services the pipeline calls:
+#   POST /computervision/imageanalysis:analyze  (Azure Image Analysis read)
+#   POST /v1/chat/completions                   (OpenAI-compatible chat completions, streamed or not)
+#   POST /doc_to_pdf                            (the remote LibreOffice converter)
+# Responses are replayed from bench/recordings with configurable latency, jitter and injected 429s.
+import argparse
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional
+
+RECORDINGS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "recordings")
+
+# Which LLM recording answers a prompt, by the template found in its messages
+LLM_RECORDINGS = {
+    "docx2json_prompt_template.txt": "docx2json.json",
+    "proofreading_prompt_template.txt": "proofreading.json",
+    "proofreading_prompt_template(nutrition).txt": "nutrition.json",
+}
+FINGERPRINT_LENGTH = 200
+
+# Smallest well-formed PDF, returned by the converter stand-in
+BLANK_PDF = (
+    b"%PDF-1.4\n1 0 obj<</Type/Catalog/Pages 2 0 R>>endobj\n"
+    b"2 0 obj<</Type/Pages/Kids[3 0 R]/Count 1>>endobj\n"
+    b"3 0 obj<</Type/Page/Parent 2 0 R/MediaBox[0 0 595 842]>>endobj\n"
+    b"trailer<</Root 1 0 R>>\n%%EOF\n"
+)
+
+class Latency:
+    """
+    Normally distributed delay in seconds, never negative.
+    """
+    def __init__(self, mean: float, jitter: float):
+        self.mean = mean
+        self.jitter = jitter
+
+    def sample(self) -> float:
+        return max(0.0, random.gauss(self.mean, self.jitter)) if self.jitter else self.mean
+
+class FakeServices:
+    def __init__(self, prompts_path: str, ocr_latency: Latency, llm_latency: Latency, pdf_latency: Latency,
+                 rate_limit: float = 0.0, retry_after: float = 1.0, chunk_size: int = 40):
+        self.ocr_latency = ocr_latency
+        self.llm_latency = llm_latency
+        self.pdf_latency = pdf_latency
+        self.rate_limit = rate_limit
+        self.retry_after = retry_after
+        self.chunk_size = chunk_size
+        self.ocr_recordings = self._load_ocr_recordings()
+        self.llm_recordings = self._load_llm_recordings(prompts_path)
+        self.counters: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        self.server: Optional[ThreadingHTTPServer] = None
+
+    def _load_ocr_recordings(self) -> List[bytes]:
+        directory = os.path.join(RECORDINGS_PATH, "ocr")
+        return [
+            open(os.path.join(directory, name), 'rb').read()
+            for name in sorted(os.listdir(directory)) if name.endswith('.json')
+        ]
+
+    def _load_llm_recordings(self, prompts_path: str) -> List[tuple]:
+        recordings = []
+        for prompt_name, recording_name in LLM_RECORDINGS.items():
+            with open(os.path.join(prompts_path, prompt_name), 'r', encoding='utf-8') as f:
+                fingerprint = f.read().strip()[:FINGERPRINT_LENGTH]
+            with open(os.path.join(RECORDINGS_PATH, "llm", recording_name), 'r', encoding='utf-8') as f:
+                recordings.append((fingerprint, f.read()))
+        return recordings
+
+    def count(self, key: str):
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + 1
+
+    def throttled(self) -> bool:
+        return self.rate_limit > 0 and random.random() < self.rate_limit
+
+    def ocr_response(self, image: bytes) -> bytes:
+        index = int(hashlib.sha256(image).hexdigest(), 16) % len(self.ocr_recordings)
+        return self.ocr_recordings[index]
+
+    def llm_response(self, prompt: str) -> str:
+        for fingerprint, content in self.llm_recordings:
+            if fingerprint in prompt:
+                return content
+        return self.llm_recordings[-1][1]
+
+    def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        services = self
+
+        class Handler(FakeServiceHandler):
+            pass
+        Handler.services = services
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True, name="fake-services").start()
+        return f"http://{host}:{self.server.server_address[1]}"
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+
+class FakeServiceHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    services: FakeServices
+
+    def log_message(self, format, *args):
+        pass
+
+    def read_body(self) -> bytes:
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def send(self, status: int, body: bytes, content_type: str = "application/json", headers: Optional[Dict] = None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_throttled(self, service: str):
+        self.services.count(f"{service}_429")
+        body = json.dumps({"error": {"code": "429", "message": "Rate limit exceeded"}}).encode()
+        self.send(429, body, headers={"Retry-After": str(self.services.retry_after)})
+
+    def do_POST(self):
+        path = self.path.split('?', 1)[0]
+        body = self.read_body()
+        if path.endswith("/imageanalysis:analyze"):
+            self.analyze(body)
+        elif path.endswith("/chat/completions"):
+            self.chat_completions(json.loads(body))
+        elif path.endswith("/doc_to_pdf"):
+            self.doc_to_pdf()
+        else:
+            self.send(404, b'{"error": "Not found"}')
+
+    def analyze(self, image: bytes):
+        services = self.services
+        if services.throttled():
+            return self.send_throttled("ocr")
+        time.sleep(services.ocr_latency.sample())
+        services.count("ocr")
+        self.send(200, services.ocr_response(image))
+
+    def chat_completions(self, request: Dict):
+        services = self.services
+        if services.throttled():
+            return self.send_throttled("llm")
+        services.count("llm")
+
+        prompt = "\n".join(message["content"] for message in request["messages"])
+        content = services.llm_response(prompt)
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+        created = int(time.time())
+        usage = {
+            "prompt_tokens": sum(len(m["content"]) for m in request["messages"]) // 2,
+            "completion_tokens": len(content) // 2,
+        }
+        usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+        latency = services.llm_latency.sample()
+
+        if not request.get("stream"):
+            time.sleep(latency)
+            return self.send(200, json.dumps({
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": created,
+                "model": request.get("model"),
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": content},
+                    "finish_reason": "stop"
+                }],
+                "usage": usage
+            }, ensure_ascii=False).encode())
+
+        # Streamed: a third of the latency before the first token, the rest spread over the chunks
+        chunks = [content[i:i + services.chunk_size] for i in range(0, len(content), services.chunk_size)]
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+        time.sleep(latency / 3)
+        try:
+            for index, chunk in enumerate(chunks):
+                last = index == len(chunks) - 1
+                event = {
+                    "id": completion_id,
+                    "object": "chat.completion.chunk",
+                    "created": created,
+                    "model": request.get("model"),
+                    "choices": [{
+                        "index": 0,
+                        "delta": {"content": chunk},
+                        "finish_reason": "stop" if last else None
+                    }]
+                }
+                if last:
+                    event["usage"] = usage
+                self.wfile.write(f"data: {json.dumps(event, ensure_ascii=False)}\n\n".encode())
+                self.wfile.flush()
+                time.sleep(latency * 2 / 3 / len(chunks))
+            self.wfile.write(b"data: [DONE]\n\n")
+        except (BrokenPipeError, ConnectionResetError):
+            # The client stopped reading once its JSON object was complete
+            pass
+
+    def doc_to_pdf(self):
+        time.sleep(self.services.pdf_latency.sample())
+        self.services.count("doc_to_pdf")
+        self.send(200, BLANK_PDF, content_type="application/pdf")
+
+def add_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument('--ocr-latency', type=float, default=1.0, help="mean OCR latency in seconds")
+    parser.add_argument('--ocr-jitter', type=float, default=0.3)
+    parser.add_argument('--llm-latency', type=float, default=4.0, help="mean LLM latency in seconds")
+    parser.add_argument('--llm-jitter', type=float, default=1.5)
+    parser.add_argument('--pdf-latency', type=float, default=1.5, help="mean DOCX to PDF latency in seconds")
+    parser.add_argument('--pdf-jitter', type=float, default=0.3)
+    parser.add_argument('--rate-limit', type=float, default=0.0, help="fraction of OCR/LLM calls answered with 429")
+    parser.add_argument('--retry-after', type=float, default=1.0)
+
+def from_arguments(args: argparse.Namespace, prompts_path: str) -> FakeServices:
+    return FakeServices(
+        prompts_path,
+        ocr_latency=Latency(args.ocr_latency, args.ocr_jitter),
+        llm_latency=Latency(args.llm_latency, args.llm_jitter),
+        pdf_latency=Latency(args.pdf_latency, args.pdf_jitter),
+        rate_limit=args.rate_limit,
+        retry_after=args.retry_after
+    )
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Serve fake OCR, LLM and DOCX to PDF endpoints")
+    parser.add_argument('--port', type=int, default=8900)
+    parser.add_argument('--prompts', default=os.getenv("PROMPTS_FOLDER_PATH", "./prompts"))
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    services = from_arguments(args, args.prompts)
+    url = services.start(port=args.port)
+    print(f"Fake services listening on {url}")
+    print(f"  AZURE_ENDPOINT={url}")
+    print(f"  LLM_BASE_URL={url}/v1")
+    print(f"  DOC_TO_PDF_URL={url}/doc_to_pdf")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        services.stop()
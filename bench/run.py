@@ -0,0 +1,218 @@
+# End-to-end benchmark of the upload path against local fake services.
+#
+#   python -m bench.run --users 8 --uploads 5 --llm-latency 4 --rate-limit 0.05
+#
+# Each simulated user logs in, then repeatedly creates a verification, uploads a DOCX
+# and a label image through POST /verifications/{id}/upload and waits for its job.
+# Stage timings come from the job's status history.
+import argparse
+import io
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from typing import Dict, List, Optional
+
+REPO_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_PATH)
+
+from bench import corpus, fake_services
+
+STAGES = ["queued", "converting", "ocr", "llm", "comparing"]
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(round(q * len(ordered))) - 1))]
+
+def summarize(values: List[float]) -> Dict[str, Optional[float]]:
+    return {
+        "count": len(values),
+        "p50": percentile(values, 0.50),
+        "p95": percentile(values, 0.95),
+        "p99": percentile(values, 0.99),
+    }
+
+def configure_environment(args: argparse.Namespace, services_url: str, work_dir: str):
+    # Set before main is imported; load_dotenv leaves variables that are already set alone
+    os.environ.update({
+        "DATABASE_URL": args.database_url or f"sqlite:///{os.path.join(work_dir, 'bench.db')}",
+        "FILES_UPLOAD_PATH": os.path.join(work_dir, "uploads"),
+        "RESULT_CACHE_PATH": os.path.join(work_dir, "cache"),
+        "PROMPTS_FOLDER_PATH": os.path.join(REPO_PATH, "prompts"),
+        "JSONS_FOLDER_PATH": os.path.join(REPO_PATH, "jsons"),
+        "SECRET_KEY": "bench",
+        "AZURE_ENDPOINT": services_url,
+        "AZURE_SUBSCRIPTION_KEY": "bench",
+        "LLM_TYPE": "openai",
+        "LLM_API_KEY": "bench",
+        "LLM_BASE_URL": f"{services_url}/v1",
+        "LLM_MODEL": "bench",
+        "LLM_PROVIDERS": "default",
+        "DOC_TO_PDF_URL": f"{services_url}/doc_to_pdf",
+        "JOB_WORKERS": str(args.workers),
+        "RULE_EXTRACTION": "false" if args.llm_only else "true",
+    })
+
+def run_user(client, samples: List[Dict], results: List[Dict], lock: threading.Lock, poll_interval: float):
+    token = client.post('/token', data={"username": "user", "password": "password"}).get_json()["access_token"]
+    headers = {"Authorization": f"Bearer {token}"}
+
+    for sample in samples:
+        response = client.post('/verifications', query_string={"verification_name": sample["name"]}, headers=headers)
+        verification_id = response.get_json()["id"]
+
+        docx_name, docx_content = sample["docx"]
+        image_name, image_content = sample["image"]
+        started = time.time()
+        response = client.post(
+            f'/verifications/{verification_id}/upload',
+            data={
+                "docx_file": (io.BytesIO(docx_content), docx_name),
+                "image_file": (io.BytesIO(image_content), image_name),
+                "ocr_scope": "full"
+            },
+            headers=headers,
+            content_type="multipart/form-data"
+        )
+        accepted = time.time()
+        if response.status_code != 202:
+            with lock:
+                results.append({"error": response.get_json(), "upload": accepted - started})
+            continue
+
+        job_id = response.get_json()["job_id"]
+        while True:
+            job = client.get(f'/jobs/{job_id}', headers=headers).get_json()
+            if job["status"] in ("completed", "failed"):
+                break
+            time.sleep(poll_interval)
+
+        with lock:
+            results.append({"upload": accepted - started, "job": job})
+
+def stage_durations(job: Dict) -> Dict[str, float]:
+    history = job["history"]
+    durations = {}
+    for (current, following) in zip(history, history[1:]):
+        durations[current["status"]] = durations.get(current["status"], 0.0) + following["at"] - current["at"]
+    return durations
+
+def report(results: List[Dict], wall_time: float, users: int) -> Dict:
+    completed = [r for r in results if r.get("job", {}).get("status") == "completed"]
+    failed = [r for r in results if r.get("job", {}).get("status") != "completed"]
+
+    stages: Dict[str, List[float]] = {stage: [] for stage in STAGES}
+    for result in completed:
+        for stage, seconds in stage_durations(result["job"]).items():
+            stages.setdefault(stage, []).append(seconds)
+
+    return {
+        "users": users,
+        "uploads": len(results),
+        "completed": len(completed),
+        "failed": len(failed),
+        "errors": [r.get("error") or r["job"].get("error") for r in failed][:10],
+        "wall_time": wall_time,
+        "throughput_per_minute": len(completed) / wall_time * 60 if wall_time else 0.0,
+        "upload_request": summarize([r["upload"] for r in results]),
+        "end_to_end": summarize([r["job"]["finished_at"] - r["job"]["created_at"] for r in completed]),
+        "stages": {stage: summarize(values) for stage, values in stages.items() if values},
+    }
+
+def print_report(summary: Dict):
+    def fmt(value: Optional[float]) -> str:
+        return "-" if value is None else f"{value:8.3f}"
+
+    print()
+    print(f"{summary['completed']}/{summary['uploads']} uploads completed by {summary['users']} users "
+          f"in {summary['wall_time']:.1f}s ({summary['throughput_per_minute']:.1f}/min)")
+    print(f"{'':16}{'count':>8}{'p50':>9}{'p95':>9}{'p99':>9}")
+    rows = [("upload request", summary["upload_request"]), ("end to end", summary["end_to_end"])]
+    rows += [(f"  {stage}", stats) for stage, stats in summary["stages"].items()]
+    for label, stats in rows:
+        print(f"{label:16}{stats['count']:8d} {fmt(stats['p50'])} {fmt(stats['p95'])} {fmt(stats['p99'])}")
+    for error in summary["errors"]:
+        print("error:", error)
+
+def check_baseline(summary: Dict, baseline_path: str, tolerance: float) -> bool:
+    """
+    Compare end-to-end and per-stage p95 with a saved run; False if any got slower than allowed.
+    """
+    with open(baseline_path, 'r', encoding='utf-8') as f:
+        baseline = json.load(f)
+
+    pairs = [("end to end", baseline["end_to_end"], summary["end_to_end"])]
+    pairs += [(stage, stats, summary["stages"].get(stage)) for stage, stats in baseline["stages"].items()]
+    ok = True
+    for label, before, after in pairs:
+        if not after or before.get("p95") is None or after.get("p95") is None:
+            continue
+        if after["p95"] > before["p95"] * (1 + tolerance):
+            print(f"REGRESSION {label}: p95 {before['p95']:.3f}s -> {after['p95']:.3f}s")
+            ok = False
+    return ok and summary["failed"] <= baseline.get("failed", 0)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark uploads end to end against fake OCR/LLM services")
+    parser.add_argument('--users', type=int, default=4, help="concurrent users")
+    parser.add_argument('--uploads', type=int, default=3, help="uploads per user")
+    parser.add_argument('--workers', type=int, default=2, help="JOB_WORKERS for the run")
+    parser.add_argument('--repeat', action='store_true', help="upload the same sample every time (measures the result cache)")
+    parser.add_argument('--database-url', help="defaults to a temporary sqlite database")
+    parser.add_argument('--llm-only', action='store_true', help="disable rule-based extraction")
+    parser.add_argument('--poll-interval', type=float, default=0.05)
+    parser.add_argument('--json', help="write the summary to this file")
+    parser.add_argument('--baseline', help="fail if p95 latencies regress against this summary")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="allowed p95 regression, as a fraction")
+    fake_services.add_arguments(parser)
+    args = parser.parse_args()
+
+    services = fake_services.from_arguments(args, os.path.join(REPO_PATH, "prompts"))
+    services_url = services.start()
+    work_dir = tempfile.mkdtemp(prefix="bench-")
+    configure_environment(args, services_url, work_dir)
+
+    import main as app_module
+    app_module.init_app()
+
+    spec = corpus.load_spec()
+    total = args.users * args.uploads
+    print(f"Generating {1 if args.repeat else total} samples in {work_dir}")
+    samples = [corpus.make_sample(0 if args.repeat else serial, spec) for serial in range(total)]
+
+    results: List[Dict] = []
+    lock = threading.Lock()
+    threads = [
+        threading.Thread(
+            target=run_user,
+            args=(app_module.app.test_client(), samples[user::args.users], results, lock, args.poll_interval)
+        )
+        for user in range(args.users)
+    ]
+    started = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall_time = time.time() - started
+
+    summary = report(results, wall_time, args.users)
+    summary["services"] = dict(services.counters)
+    summary["scheduler"] = app_module.scheduler.scheduler_stats()
+    summary["llm"] = app_module.llm_stats()
+    print_report(summary)
+    print("fake services:", summary["services"])
+    services.stop()
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(summary, f, ensure_ascii=False, indent=2)
+    if args.baseline and not check_baseline(summary, args.baseline, args.tolerance):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
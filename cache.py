@@ -0,0 +1,200 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Optional
+
+
+def content_key(*parts: Any) -> str:
+    """
+    Build a stable SHA-256 key from the given parts (file hashes, scopes, versions...).
+    """
+    return hashlib.sha256(json.dumps(parts, ensure_ascii=False, default=str).encode('utf-8')).hexdigest()
+
+class ResultCache:
+    """
+    Content-addressed JSON cache stored as one file per key.
+
+    Entries older than max_age seconds are treated as misses and removed. When the
+    directory grows past max_bytes, least recently used entries are evicted first
+    (reads refresh an entry's mtime). The directory's size is tracked in memory, so it is
+    only scanned on the first write, when over max_bytes, and every sweep_every writes
+    to drop expired entries that are never read again.
+    """
+    def __init__(self, directory: str, max_bytes: int = 256 * 1024 * 1024, max_age: float = 30 * 24 * 3600,
+                 sweep_every: int = 1000):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.sweep_every = sweep_every
+        self.hits = 0
+        self.misses = 0
+        # Unknown until the first scan
+        self._size: Optional[int] = None
+        self._writes = 0
+        self._counts_lock = threading.Lock()
+        self._lock = threading.Lock()
+        self._inflight: Dict[str, list] = {}
+        self._inflight_lock = threading.Lock()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], f"{key}.json")
+
+    def get(self, key: str) -> Optional[Dict]:
+        path = self._path(key)
+        try:
+            stat = os.stat(path)
+            if time.time() - stat.st_mtime > self.max_age:
+                os.remove(path)
+                self._resize(-stat.st_size)
+                raise FileNotFoundError(path)
+            with open(path, 'r', encoding='utf-8') as f:
+                value = json.load(f)
+            os.utime(path)
+        except (OSError, ValueError):
+            with self._counts_lock:
+                self.misses += 1
+            return None
+        with self._counts_lock:
+            self.hits += 1
+        return value
+
+    def put(self, key: str, value: Dict):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        try:
+            replaced = os.path.getsize(path)
+        except OSError:
+            replaced = 0
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(value, f, ensure_ascii=False)
+        written = os.path.getsize(tmp_path)
+        os.replace(tmp_path, path)
+
+        with self._counts_lock:
+            self._writes += 1
+            if self._size is not None:
+                self._size += written - replaced
+            scan = self._size is None or self._size > self.max_bytes or self._writes % self.sweep_every == 0
+        # A scan already running brings the size down for this write too
+        if scan and self._lock.acquire(blocking=False):
+            try:
+                self._evict()
+            finally:
+                self._lock.release()
+
+    def _resize(self, delta: int):
+        with self._counts_lock:
+            if self._size is not None:
+                self._size += delta
+
+    def get_or_compute(self, key: str, compute: Callable[[], Any],
+                       cacheable: Callable[[Any], bool] = lambda value: value is not None) -> Any:
+        """
+        Return the cached value, or compute and cache it. Concurrent callers with the
+        same key wait for the first computation instead of repeating it.
+        """
+        value = self.get(key)
+        if value is not None:
+            return value
+
+        with self._inflight_lock:
+            entry = self._inflight.setdefault(key, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                # Another caller may have filled it while we waited
+                value = self.get(key)
+                if value is not None:
+                    return value
+                value = compute()
+                if cacheable(value):
+                    self.put(key, value)
+                return value
+        finally:
+            with self._inflight_lock:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self._inflight[key]
+
+    def evict(self):
+        """
+        Drop expired entries, then the least recently used ones until under max_bytes.
+        """
+        with self._lock:
+            self._evict()
+
+    def _evict(self):
+        now = time.time()
+        entries = []
+        total = 0
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if not name.endswith('.json'):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                    if now - stat.st_mtime > self.max_age:
+                        os.remove(path)
+                        continue
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+                total += stat.st_size
+
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+        with self._counts_lock:
+            self._size = total
+
+    def stats(self) -> Dict[str, int]:
+        with self._counts_lock:
+            return {"hits": self.hits, "misses": self.misses}
+
+class TTLCache:
+    """
+    Small in-memory LRU cache whose entries also expire after ttl seconds.
+    """
+    def __init__(self, max_size: int = 1024, ttl: float = 60):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries: "OrderedDict[Any, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Any) -> Any:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if time.monotonic() > expires_at:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key: Any, value: Any):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key: Any):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
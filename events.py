@@ -0,0 +1,66 @@
+import itertools
+import json
+import queue
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+
+
+def format_sse(event: Dict[str, Any]) -> str:
+    """
+    Serialize an event for a text/event-stream response.
+    """
+    data = json.dumps(event["data"], ensure_ascii=False)
+    return f"id: {event['id']}\nevent: {event['event']}\ndata: {data}\n\n"
+
+class EventBus:
+    """
+    In-process publish/subscribe keyed by topic (a verification id).
+
+    The events of a topic's current run are kept so that late or reconnecting
+    subscribers are replayed everything they missed before receiving live events.
+    """
+    def __init__(self, max_topics: int = 1000):
+        self.max_topics = max_topics
+        self._ids = itertools.count(1)
+        self._history: "OrderedDict[Any, List[Dict[str, Any]]]" = OrderedDict()
+        self._subscribers: Dict[Any, List[queue.Queue]] = {}
+        self._lock = threading.Lock()
+
+    def reset(self, topic):
+        """
+        Start a new run for the topic, forgetting the events of the previous one.
+        """
+        with self._lock:
+            self._history[topic] = []
+            self._history.move_to_end(topic)
+            while len(self._history) > self.max_topics:
+                self._history.popitem(last=False)
+
+    def publish(self, topic, event: str, data: Any):
+        with self._lock:
+            message = {"id": next(self._ids), "event": event, "data": data}
+            self._history.setdefault(topic, []).append(message)
+            for subscriber in self._subscribers.get(topic, []):
+                subscriber.put(message)
+
+    def subscribe(self, topic, last_event_id: Optional[int] = None) -> queue.Queue:
+        with self._lock:
+            subscriber: queue.Queue = queue.Queue()
+            for message in self._history.get(topic, []):
+                if last_event_id is None or message["id"] > last_event_id:
+                    subscriber.put(message)
+            self._subscribers.setdefault(topic, []).append(subscriber)
+            return subscriber
+
+    def unsubscribe(self, topic, subscriber: queue.Queue):
+        with self._lock:
+            subscribers = self._subscribers.get(topic, [])
+            if subscriber in subscribers:
+                subscribers.remove(subscriber)
+            if not subscribers:
+                self._subscribers.pop(topic, None)
+
+    def has_history(self, topic) -> bool:
+        with self._lock:
+            return bool(self._history.get(topic))
@@ -0,0 +1,182 @@
+import os
+import re
+from typing import Any, Dict, List, Tuple
+
+# Fill output templates from the label text directly when its headings are unambiguous
+RULE_EXTRACTION = os.getenv("RULE_EXTRACTION", "true").lower() == "true"
+RULES_VERSION = "2"
+
+NUTRITION = "營養標示"
+TITLE = "title_vailed"
+
+# Other headings a field goes by; the field's own name is always accepted
+HEADING_ALIASES = {
+    "公司名稱": ("製造商", "製造廠商", "廠商名稱"),
+}
+
+# A nutrition table value: an amount with its unit, a percentage, or "*"
+QUANTITY = re.compile(r"^(\*|\d+(\.\d+)?(大卡|千卡|公克|毫克|微克|公斤|毫升|%|kcal|g|mg|μg|ml))$", re.IGNORECASE)
+UNIT = re.compile(r"^(大卡|千卡|公克|毫克|微克|公斤|毫升|%|kcal|g|mg|μg|ml)$", re.IGNORECASE)
+
+Path = Tuple[str, ...]
+
+# A heading starts the text, a line or a clause, so "品名:" is not found inside "商品名:"
+HEADING_START = r"(?<![^\s,，;；。、])"
+
+def heading_pattern(field: str) -> "re.Pattern":
+    names = (field,) + HEADING_ALIASES.get(field, ())
+    return re.compile(HEADING_START + "(?:" + "|".join(re.escape(name) for name in names) + ")[:：]")
+
+def starts_block(line: str) -> bool:
+    # Table rows and the nutrition table title end a field's continuation lines
+    return not line.strip() or "\t" in line or line.strip().startswith(NUTRITION)
+
+def filled(template: Dict, **values: str) -> Dict:
+    value = {key: "true" if key == TITLE else "" for key in template}
+    value.update(values)
+    return value
+
+def extract_sections(text: str, template: Dict) -> Tuple[Dict, List[Path]]:
+    """
+    Fields written as "heading:content". A field's content runs to the next heading or the
+    end of its block; wrapped lines are joined. A field whose heading is missing, or whose
+    content is empty, is left unresolved. If any heading occurs more than once the
+    boundaries can't be trusted and every field is left unresolved.
+    """
+    fields = [key for key, value in template.items() if key != NUTRITION and "content" in value]
+    matches = {field: list(heading_pattern(field).finditer(text)) for field in fields}
+    if any(len(found) > 1 for found in matches.values()):
+        return {}, [(field,) for field in fields]
+
+    found = sorted((found[0].start(), found[0].end(), field) for field, found in matches.items() if found)
+    result: Dict[str, Dict] = {}
+    unresolved: List[Path] = [(field,) for field in fields if not matches[field]]
+    for index, (_, end, field) in enumerate(found):
+        last = index == len(found) - 1
+        pieces = text[end:found[index + 1][0] if not last else len(text)].split("\n")
+        content = [pieces[0].strip()]
+        ended = False
+        for piece in pieces[1:]:
+            if starts_block(piece):
+                ended = True
+                break
+            content.append(piece.strip())
+        value = "".join(content)
+        # After the last heading there is nothing to tell a wrapped line from unrelated text
+        if not value or (last and len(content) > 1 and not ended):
+            unresolved.append((field,))
+            continue
+        result[field] = filled(template[field], content=value)
+    return result, unresolved
+
+def split_cells(line: str) -> List[str]:
+    cells: List[str] = []
+    for token in line.split():
+        # "158 大卡" is one value
+        if cells and UNIT.match(token) and cells[-1][-1:].isdigit():
+            cells[-1] += token
+        else:
+            cells.append(token)
+    return cells
+
+def extract_nutrition(text: str, template: Dict) -> Tuple[Dict, List[Path]]:
+    """
+    The nutrition table, one row per line: a row label followed by its values in column
+    order. Rows that are missing, repeated or whose values don't look like amounts are
+    left unresolved.
+    """
+    if NUTRITION not in template:
+        return {}, []
+    spec = template[NUTRITION]
+    rows: Dict[str, List[List[str]]] = {}
+    titles = 0
+    for line in text.split("\n"):
+        cells = split_cells(line)
+        if not cells:
+            continue
+        if cells[0] == NUTRITION:
+            titles += 1
+            continue
+        for label, entry in spec.items():
+            if label == TITLE:
+                continue
+            if cells[0] == label:
+                rows.setdefault(label, []).append(cells[1:])
+            elif "content" in entry and cells[0].startswith(label):
+                # "每一份量35公克" or "每一份量:35公克"
+                rows.setdefault(label, []).append([cells[0][len(label):].lstrip(":：")] + cells[1:])
+
+    result: Dict[str, Any] = {}
+    unresolved: List[Path] = []
+    if TITLE in spec:
+        if titles == 1:
+            result[TITLE] = "true"
+        else:
+            unresolved.append((NUTRITION, TITLE))
+
+    for label, entry in spec.items():
+        if label == TITLE:
+            continue
+        columns = [key for key in entry if key != TITLE]
+        if not columns:
+            # Title-only entries (the 每100公克 column) are checked by the caller
+            continue
+        found = rows.get(label, [])
+        if len(found) != 1:
+            unresolved.append((NUTRITION, label))
+            continue
+        values = [value for value in found[0] if value]
+        if columns == ["content"]:
+            if not values:
+                unresolved.append((NUTRITION, label))
+                continue
+            result[label] = filled(entry, content=" ".join(values))
+        elif len(values) == len(columns) and all(QUANTITY.match(value) for value in values):
+            result[label] = filled(entry, **dict(zip(columns, values)))
+        else:
+            unresolved.append((NUTRITION, label))
+
+    return ({NUTRITION: result} if result else {}), unresolved
+
+def extract(text: str, template: Dict) -> Tuple[Dict, List[Path]]:
+    """
+    Fill an output template from label or specification text without the LLM.
+    Returns the fields that could be resolved and the paths of those that could not.
+    """
+    sections, unresolved = extract_sections(text, template)
+    nutrition, unresolved_nutrition = extract_nutrition(text, template)
+    return {**sections, **nutrition}, unresolved + unresolved_nutrition
+
+def fill_unresolved(extracted: Dict, answer: Dict, unresolved: List[Path]) -> Dict:
+    """
+    Copy the unresolved paths from the LLM's answer into the extracted result.
+    """
+    for path in unresolved:
+        source: Any = answer
+        for key in path:
+            source = source.get(key) if isinstance(source, dict) else None
+        if source is None:
+            continue
+        target = extracted
+        for key in path[:-1]:
+            target = target.setdefault(key, {})
+        target[path[-1]] = source
+    return extracted
+
+def arrange(template: Dict, data: Dict) -> Dict:
+    """
+    The keys of `data` in template order, as the LLM would have written them.
+    """
+    ordered = {}
+    for key, value in template.items():
+        if key in data:
+            ordered[key] = arrange(value, data[key]) if isinstance(value, dict) and isinstance(data[key], dict) else data[key]
+    for key, value in data.items():
+        ordered.setdefault(key, value)
+    return ordered
+
+def version() -> str:
+    """
+    Part of the cache key of outputs that may come from the extractor.
+    """
+    return f"rules{RULES_VERSION}" if RULE_EXTRACTION else "norules"
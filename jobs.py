@@ -0,0 +1,160 @@
+import enum
+import queue
+import threading
+import time
+import traceback
+import uuid
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import metrics
+
+
+class JobStatus(str, enum.Enum):
+    QUEUED = "queued"
+    CONVERTING = "converting"
+    OCR = "ocr"
+    LLM = "llm"
+    COMPARING = "comparing"
+    COMPLETED = "completed"
+    FAILED = "failed"
+
+# Statuses that mean a job still owns the verification
+ACTIVE_STATUSES = [
+    JobStatus.QUEUED,
+    JobStatus.CONVERTING,
+    JobStatus.OCR,
+    JobStatus.LLM,
+    JobStatus.COMPARING
+]
+
+class JobError(Exception):
+    """
+    Raised by a job handler to fail a job with a client-facing error payload.
+    """
+    def __init__(self, payload: Dict[str, Any]):
+        super().__init__(payload.get("error_type") or payload.get("error"))
+        self.payload = payload
+
+class Job:
+    def __init__(self, verification_id: int, user_id: int, payload: Dict[str, Any]):
+        self.id = uuid.uuid4().hex
+        self.verification_id = verification_id
+        self.user_id = user_id
+        self.payload = payload
+        self.status = JobStatus.QUEUED
+        self.error: Optional[Dict[str, Any]] = None
+        self.result: Optional[Dict[str, Any]] = None
+        self.created_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.history: List[Tuple[JobStatus, float]] = [(JobStatus.QUEUED, self.created_at)]
+        self._lock = threading.Lock()
+
+    def set_status(self, status: JobStatus):
+        with self._lock:
+            self.status = status
+            self.history.append((status, time.time()))
+
+    def advance(self, status: JobStatus) -> bool:
+        """
+        Move to a later stage; stages reported out of order by parallel branches are ignored.
+        """
+        with self._lock:
+            if self.status in ACTIVE_STATUSES and status in ACTIVE_STATUSES and \
+                    ACTIVE_STATUSES.index(status) <= ACTIVE_STATUSES.index(self.status):
+                return False
+            self.status = status
+            self.history.append((status, time.time()))
+            return True
+
+    @property
+    def finished(self) -> bool:
+        return self.status in (JobStatus.COMPLETED, JobStatus.FAILED)
+
+    def to_dict(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "job_id": self.id,
+                "verification_id": self.verification_id,
+                "status": self.status.value,
+                "error": self.error,
+                "result": self.result,
+                "created_at": self.created_at,
+                "started_at": self.started_at,
+                "finished_at": self.finished_at,
+                "history": [{"status": s.value, "at": t} for s, t in self.history]
+            }
+
+class JobQueue:
+    """
+    In-process job queue served by a fixed pool of daemon worker threads.
+
+    The handler receives the Job and runs it to completion. Returning normally
+    completes the job with the returned value as its result; raising JobError
+    fails it with the error's payload, and any other exception fails it with
+    the exception message.
+    """
+    def __init__(self, handler: Callable[[Job], Optional[Dict[str, Any]]], workers: int = 2,
+                 name: str = "jobs", max_finished: int = 1000):
+        self.handler = handler
+        self.workers = max(1, workers)
+        self.name = name
+        self.max_finished = max_finished
+        self._queue: "queue.Queue[Job]" = queue.Queue()
+        self._jobs: "OrderedDict[str, Job]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._threads: List[threading.Thread] = []
+        metrics.QUEUE_DEPTH.labels(name).set_function(self.pending)
+
+    def start(self):
+        with self._lock:
+            if self._threads:
+                return
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._run, name=f"{self.name}-worker-{i}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def submit(self, verification_id: int, user_id: int, payload: Dict[str, Any]) -> Job:
+        self.start()
+        job = Job(verification_id, user_id, payload)
+        with self._lock:
+            self._jobs[job.id] = job
+            self._evict_finished()
+        self._queue.put(job)
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def pending(self) -> int:
+        return self._queue.qsize()
+
+    def _evict_finished(self):
+        # Keep the registry bounded; only finished jobs are ever dropped
+        overflow = len(self._jobs) - self.max_finished
+        if overflow <= 0:
+            return
+        for job_id in [j.id for j in self._jobs.values() if j.finished][:overflow]:
+            del self._jobs[job_id]
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            job.started_at = time.time()
+            try:
+                job.result = self.handler(job)
+                job.set_status(JobStatus.COMPLETED)
+            except JobError as e:
+                job.error = e.payload
+                job.set_status(JobStatus.FAILED)
+            except Exception as e:
+                traceback.print_exc()
+                job.error = {"error": str(e)}
+                job.set_status(JobStatus.FAILED)
+            finally:
+                job.finished_at = time.time()
+                metrics.observe_job(self.name, job)
+                self._queue.task_done()
@@ -0,0 +1,160 @@
+import json
+from typing import Any, List, Optional
+
+
+class MalformedJSONError(ValueError):
+    pass
+
+class JSONObjectScanner:
+    """
+    Finds the first top-level JSON object in text that arrives in chunks.
+
+    feed() returns the object's text as soon as its closing brace arrives, so the
+    caller can stop reading. Mismatched brackets or too much text before the
+    object raise MalformedJSONError straight away. Brackets are not counted inside
+    the strings and comments that repair_json accepts: double- or single-quoted
+    strings, // line comments and /* */ block comments.
+    """
+    CLOSERS = {'}': '{', ']': '['}
+
+    def __init__(self, max_preamble: int = 2000):
+        self.max_preamble = max_preamble
+        self.preamble = 0
+        self.parts: List[str] = []
+        self.stack: List[str] = []
+        # The quote of the string being read, "//" or "/*" inside a comment, else None
+        self.context: Optional[str] = None
+        self.escape = False
+        # The last character, when it may start or end a comment across a chunk boundary
+        self.pending = ''
+        self.result: Optional[str] = None
+
+    def feed(self, chunk: str) -> Optional[str]:
+        if self.result is not None:
+            return self.result
+
+        start = 0
+        if not self.stack:
+            # Skip any chatter or code fence before the object
+            start = chunk.find('{')
+            if start == -1:
+                self.preamble += len(chunk)
+                if self.preamble > self.max_preamble:
+                    raise MalformedJSONError("No JSON object found in response")
+                return None
+
+        for i in range(start, len(chunk)):
+            char = chunk[i]
+            previous, self.pending = self.pending, ''
+            if self.context == '//':
+                if char == '\n':
+                    self.context = None
+            elif self.context == '/*':
+                if previous == '*' and char == '/':
+                    self.context = None
+                elif char == '*':
+                    self.pending = char
+            elif self.context is not None:
+                if self.escape:
+                    self.escape = False
+                elif char == '\\':
+                    self.escape = True
+                elif char == self.context:
+                    self.context = None
+            elif previous == '/' and char in '/*':
+                self.context = previous + char
+            elif char in '"\'':
+                self.context = char
+            elif char == '/':
+                self.pending = char
+            elif char in '{[':
+                self.stack.append(char)
+            elif char in self.CLOSERS:
+                if not self.stack or self.stack.pop() != self.CLOSERS[char]:
+                    raise MalformedJSONError(f"Unbalanced '{char}' in JSON response")
+                if not self.stack:
+                    self.parts.append(chunk[start:i + 1])
+                    self.result = ''.join(self.parts)
+                    return self.result
+
+        self.parts.append(chunk[start:])
+        return None
+
+    def finish(self) -> str:
+        """
+        Called once the stream has ended; fails if no complete object was seen.
+        """
+        if self.result is None:
+            raise MalformedJSONError("Response ended before the JSON object was complete")
+        return self.result
+
+# Python literals that models sometimes emit instead of JSON ones
+LITERALS = {'True': 'true', 'False': 'false', 'None': 'null'}
+
+def repair_json(text: str) -> str:
+    """
+    Rewrite the JSON-like output of a model as JSON in a single pass: comments are
+    dropped, single-quoted strings become double-quoted, trailing commas are removed
+    and Python literals are translated. Text inside strings is left alone.
+    """
+    out: List[str] = []
+    i, n = 0, len(text)
+    while i < n:
+        char = text[i]
+        if char in '"\'':
+            j = i + 1
+            body: List[str] = []
+            while j < n and text[j] != char:
+                if text[j] == '\\' and j + 1 < n:
+                    body.append(text[j:j + 2])
+                    j += 2
+                    continue
+                body.append(text[j])
+                j += 1
+            content = ''.join(body)
+            if char == "'":
+                content = content.replace("\\'", "'").replace('"', '\\"')
+            out.append('"' + content + '"')
+            i = j + 1
+        elif text.startswith('//', i):
+            end = text.find('\n', i)
+            i = n if end == -1 else end
+        elif text.startswith('/*', i):
+            end = text.find('*/', i + 2)
+            i = n if end == -1 else end + 2
+        elif char == ',':
+            j = i + 1
+            while j < n and text[j].isspace():
+                j += 1
+            if j >= n or text[j] not in '}]':
+                out.append(char)
+            i += 1
+        elif char.isalpha():
+            j = i
+            while j < n and (text[j].isalnum() or text[j] == '_'):
+                j += 1
+            word = text[i:j]
+            out.append(LITERALS.get(word, word))
+            i = j
+        else:
+            out.append(char)
+            i += 1
+    return ''.join(out)
+
+def parse_llm_json(text: str) -> Any:
+    """
+    Parse the JSON object in a model response, repairing it if plain parsing fails.
+    """
+    start = text.find('{')
+    end = text.rfind('}')
+    if start == -1 or end == -1:
+        raise MalformedJSONError("No valid JSON found in response")
+    text = text[start:end + 1]
+    try:
+        return json.loads(text, strict=False)
+    except ValueError:
+        pass
+    try:
+        return json.loads(repair_json(text), strict=False)
+    except ValueError as e:
+        raise MalformedJSONError(f"Invalid JSON in response: {str(e)}")
@@ -1,77 +1,716 @@
 from openai import OpenAI, AzureOpenAI
+import httpx
 import requests
+from requests.adapters import HTTPAdapter
 import os
-from dotenv import load_dotenv
-import requests
+import json
+import threading
 import time
+import contextvars
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
+from contextlib import closing, contextmanager
+from typing import Callable, Dict, Iterator, List, Optional, Union
+from dotenv import load_dotenv
+from jsonstream import JSONObjectScanner, MalformedJSONError
+from scheduler import get_scheduler
+from prompt_builder import SYSTEM_PROMPT, count_tokens, count_message_tokens
+import metrics
 
 # Load environment variables from .env file
 load_dotenv()
 llm_type = os.getenv("LLM_TYPE")
-def llm(prompt):
-    if llm_type == "openai":
-        client = OpenAI(
-            api_key=os.getenv("LLM_API_KEY"),
-            base_url=os.getenv("LLM_BASE_URL"),
+
+# Connection pool tuning shared by every provider
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "120"))
+LLM_POOL_CONNECTIONS = int(os.getenv("LLM_POOL_CONNECTIONS", "20"))
+LLM_KEEPALIVE_SECONDS = float(os.getenv("LLM_KEEPALIVE_SECONDS", "60"))
+
+# Streaming lets llm_json stop reading as soon as the JSON object is complete
+LLM_STREAM = os.getenv("LLM_STREAM", "true").lower() == "true"
+LLM_STREAM_RETRIES = int(os.getenv("LLM_STREAM_RETRIES", "2"))
+# Ask OpenAI-compatible providers to report token usage at the end of a stream
+LLM_STREAM_USAGE = os.getenv("LLM_STREAM_USAGE", "true").lower() == "true"
+
+# Per-call token budget; 0 disables a limit
+LLM_MAX_INPUT_TOKENS = int(os.getenv("LLM_MAX_INPUT_TOKENS", "12000"))
+LLM_MAX_OUTPUT_TOKENS = int(os.getenv("LLM_MAX_OUTPUT_TOKENS", "4096"))
+
+# Failover across the providers listed in LLM_PROVIDERS
+DEFAULT_PROFILE = "default"
+LLM_HEDGE = os.getenv("LLM_HEDGE", "true").lower() == "true"
+LLM_HEDGE_DEFAULT_DELAY = float(os.getenv("LLM_HEDGE_DEFAULT_DELAY", "20"))
+LLM_HEDGE_MIN_DELAY = float(os.getenv("LLM_HEDGE_MIN_DELAY", "2"))
+LLM_BREAKER_FAILURES = int(os.getenv("LLM_BREAKER_FAILURES", "5"))
+LLM_BREAKER_COOLDOWN = float(os.getenv("LLM_BREAKER_COOLDOWN", "30"))
+
+class ConnectionStats:
+    """
+    Counts requests against newly opened connections, so reuse = requests - connections.
+    """
+    def __init__(self):
+        self.requests = 0
+        self.connections = 0
+        self._lock = threading.Lock()
+
+    def add_request(self):
+        with self._lock:
+            self.requests += 1
+
+    def add_connection(self):
+        with self._lock:
+            self.connections += 1
+
+    def to_dict(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "connections": self.connections,
+                "reused": max(0, self.requests - self.connections)
+            }
+
+def build_http_client(stats: ConnectionStats) -> httpx.Client:
+    """
+    httpx client with a keep-alive pool; connection opens are counted through httpcore's trace hook.
+    """
+    def trace(event_name: str, info: Dict):
+        if event_name == "connection.connect_tcp.complete":
+            stats.add_connection()
+
+    def on_request(request: httpx.Request):
+        stats.add_request()
+        request.extensions["trace"] = trace
+
+    return httpx.Client(
+        limits=httpx.Limits(
+            max_connections=LLM_POOL_CONNECTIONS,
+            max_keepalive_connections=LLM_POOL_CONNECTIONS,
+            keepalive_expiry=LLM_KEEPALIVE_SECONDS
+        ),
+        timeout=LLM_TIMEOUT,
+        event_hooks={"request": [on_request]}
+    )
+
+class LLMProvider:
+    """
+    A chat-completion backend. Each provider builds its client once and reuses it.
+    """
+    name = "base"
+
+    def __init__(self, api_key: Optional[str], base_url: Optional[str], model: Optional[str],
+                 api_version: Optional[str] = None):
+        self.api_key = api_key
+        self.base_url = base_url
+        self.model = model
+        self.api_version = api_version
+        self.connection_stats = ConnectionStats()
+
+    def complete(self, messages: List[Dict[str, str]], timeout: Optional[float] = None,
+                 usage: Optional[Dict[str, int]] = None) -> str:
+        """
+        Return the completion text. Token counts reported by the provider are stored in `usage`.
+        """
+        raise NotImplementedError
+
+    def stream(self, messages: List[Dict[str, str]], timeout: Optional[float] = None,
+               usage: Optional[Dict[str, int]] = None) -> Iterator[str]:
+        """
+        Yield the completion text as it arrives. Closing the generator ends the request.
+        Token counts are stored in `usage` if the stream is read to its end.
+        """
+        raise NotImplementedError
+
+    def stream_usage(self) -> bool:
+        """
+        Whether the end of a stream reports token usage.
+        """
+        return False
+
+    def stats(self) -> Dict:
+        return {"provider": self.name, "model": self.model, **self.connection_stats.to_dict()}
+
+class OpenAIProvider(LLMProvider):
+    name = "openai"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.client = self.build_client(build_http_client(self.connection_stats))
+
+    def build_client(self, http_client: httpx.Client):
+        return OpenAI(
+            api_key=self.api_key,
+            base_url=self.base_url,
+            http_client=http_client,
+            # 429s are retried by the scheduler, which also backs off its concurrency
+            max_retries=0
         )
-        response = client.chat.completions.create(
-            model=os.getenv("LLM_MODEL"),
-            messages=[
-                {"role": "system", "content": "You are a package proofreading system"},
-                {"role": "user", "content": prompt},
-            ],
+
+    def complete(self, messages: List[Dict[str, str]], timeout: Optional[float] = None,
+                 usage: Optional[Dict[str, int]] = None) -> str:
+        response = self.client.chat.completions.create(
+            model=self.model,
+            messages=messages,
             temperature=0,
-            stream=False
+            stream=False,
+            timeout=timeout or LLM_TIMEOUT,
+            **self.limits()
         )
+        if usage is not None and response.usage:
+            usage.update(prompt_tokens=response.usage.prompt_tokens, completion_tokens=response.usage.completion_tokens)
         return response.choices[0].message.content
 
-    elif llm_type == "azure":
-        client = AzureOpenAI(
-            api_key=os.getenv("LLM_API_KEY"),
-            api_version=os.getenv("LLM_API_VERSION"),
-            base_url=os.getenv("LLM_BASE_URL"),
-        )
-        response = client.chat.completions.create(
-            model=os.getenv("LLM_MODEL"),
-            messages=[
-                {"role": "system", "content": "You are a package proofreading system"},
-                {"role": "user", "content": prompt},
-            ],
+    def stream(self, messages: List[Dict[str, str]], timeout: Optional[float] = None,
+               usage: Optional[Dict[str, int]] = None) -> Iterator[str]:
+        # With include_usage the last chunk carries the token counts
+        extra = {"stream_options": {"include_usage": True}} if LLM_STREAM_USAGE else {}
+        extra.update(self.limits())
+        response = self.client.chat.completions.create(
+            model=self.model,
+            messages=messages,
             temperature=0,
-            stream=False
+            stream=True,
+            timeout=timeout or LLM_TIMEOUT,
+            **extra
         )
-        return response.choices[0].message.content
+        with closing(response):
+            for chunk in response:
+                if usage is not None and getattr(chunk, "usage", None):
+                    usage.update(prompt_tokens=chunk.usage.prompt_tokens, completion_tokens=chunk.usage.completion_tokens)
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+
+    def limits(self) -> Dict[str, int]:
+        return {"max_tokens": LLM_MAX_OUTPUT_TOKENS} if LLM_MAX_OUTPUT_TOKENS else {}
+
+    def stream_usage(self) -> bool:
+        return LLM_STREAM_USAGE
+
+class AzureProvider(OpenAIProvider):
+    name = "azure"
+
+    def build_client(self, http_client: httpx.Client):
+        return AzureOpenAI(
+            api_key=self.api_key,
+            api_version=self.api_version,
+            base_url=self.base_url,
+            http_client=http_client,
+            # 429s are retried by the scheduler, which also backs off its concurrency
+            max_retries=0
+        )
+
+class OllamaProvider(LLMProvider):
+    name = "ollama"
+
+    def __init__(self, api_key: Optional[str], base_url: Optional[str], model: Optional[str],
+                 api_version: Optional[str] = None):
+        super().__init__(api_key, base_url or "http://localhost:11434", model or "llama2", api_version)
+        self.adapter = HTTPAdapter(pool_connections=1, pool_maxsize=LLM_POOL_CONNECTIONS)
+        self.session = requests.Session()
+        self.session.mount("http://", self.adapter)
+        self.session.mount("https://", self.adapter)
+
+    def complete(self, messages: List[Dict[str, str]], timeout: Optional[float] = None,
+                 usage: Optional[Dict[str, int]] = None) -> str:
+        url = f"{self.base_url}/api/chat"
 
-    elif llm_type == "ollama":
-        base_url = os.getenv("LLM_BASE_URL", "http://localhost:11434")
-        model = os.getenv("LLM_MODEL", "llama2")
-        
-        url = f"{base_url}/api/chat"
-        
         payload = {
-            "model": model,
-            "messages": [
-                {"role": "system", "content": "You are a package proofreading system"},
-                {"role": "user", "content": prompt}
-            ],
-            "options": {
-                "temperature": 0
-            },
+            "model": self.model,
+            "messages": messages,
+            "options": self.options(),
             "stream": False
         }
-        
+
         try:
-            response = requests.post(url, json=payload)
+            self.connection_stats.add_request()
+            response = self.session.post(url, json=payload, timeout=timeout or LLM_TIMEOUT)
             response.raise_for_status()
-            # print(response.json()["message"]["content"])
-            return response.json()["message"]["content"]
+            result = response.json()
+            self.read_usage(result, usage)
+            return result["message"]["content"]
         except requests.exceptions.RequestException as e:
             raise ConnectionError(f"Failed to connect to Ollama: {str(e)}")
         except (KeyError, ValueError) as e:
             raise ValueError(f"Invalid response from Ollama: {str(e)}")
-    
+
+    def stream(self, messages: List[Dict[str, str]], timeout: Optional[float] = None,
+               usage: Optional[Dict[str, int]] = None) -> Iterator[str]:
+        url = f"{self.base_url}/api/chat"
+
+        payload = {
+            "model": self.model,
+            "messages": messages,
+            "options": self.options(),
+            "stream": True
+        }
+
+        try:
+            self.connection_stats.add_request()
+            response = self.session.post(url, json=payload, timeout=timeout or LLM_TIMEOUT, stream=True)
+            response.raise_for_status()
+        except requests.exceptions.RequestException as e:
+            raise ConnectionError(f"Failed to connect to Ollama: {str(e)}")
+
+        # Ollama streams one JSON message per line
+        with closing(response):
+            try:
+                for line in response.iter_lines():
+                    if not line:
+                        continue
+                    chunk = json.loads(line)
+                    if chunk.get("message", {}).get("content"):
+                        yield chunk["message"]["content"]
+                    if chunk.get("done"):
+                        self.read_usage(chunk, usage)
+                        break
+            except requests.exceptions.RequestException as e:
+                raise ConnectionError(f"Failed to connect to Ollama: {str(e)}")
+            except ValueError as e:
+                raise ValueError(f"Invalid response from Ollama: {str(e)}")
+
+    def stream_usage(self) -> bool:
+        return True
+
+    @staticmethod
+    def options() -> Dict:
+        options = {"temperature": 0}
+        if LLM_MAX_OUTPUT_TOKENS:
+            options["num_predict"] = LLM_MAX_OUTPUT_TOKENS
+        return options
+
+    @staticmethod
+    def read_usage(result: Dict, usage: Optional[Dict[str, int]]):
+        # The final message reports prompt and completion token counts
+        if usage is not None and "eval_count" in result:
+            usage.update(prompt_tokens=result.get("prompt_eval_count", 0), completion_tokens=result["eval_count"])
+
+    def stats(self) -> Dict:
+        # urllib3 counts the connections each host pool has opened
+        pools = self.adapter.poolmanager.pools
+        self.connection_stats.connections = sum(pools[key].num_connections for key in pools.keys())
+        return super().stats()
+
+PROVIDERS = {
+    "openai": OpenAIProvider,
+    "azure": AzureProvider,
+    "ollama": OllamaProvider
+}
+
+def build_provider(provider_type: Optional[str], api_key: Optional[str], base_url: Optional[str],
+                   model: Optional[str], api_version: Optional[str] = None) -> LLMProvider:
+    if provider_type not in PROVIDERS:
+        raise ValueError(f"Unsupported LLM type: {provider_type}")
+    return PROVIDERS[provider_type](api_key, base_url, model, api_version)
+
+class CircuitBreaker:
+    """
+    Opens after `failures` consecutive errors and rejects calls for `cooldown` seconds,
+    then lets a single trial call through (half-open) to decide whether to close again.
+    """
+    def __init__(self, failures: int = 5, cooldown: float = 30):
+        self.failures = failures
+        self.cooldown = cooldown
+        self.consecutive_failures = 0
+        self.opened_at: Optional[float] = None
+        self.trial_running = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        return "half_open" if time.monotonic() - self.opened_at >= self.cooldown else "open"
+
+    def allow(self) -> bool:
+        with self._lock:
+            state = self.state
+            if state == "closed":
+                return True
+            if state == "half_open" and not self.trial_running:
+                self.trial_running = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.consecutive_failures = 0
+            self.opened_at = None
+            self.trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self.consecutive_failures += 1
+            if self.trial_running or self.consecutive_failures >= self.failures:
+                self.opened_at = time.monotonic()
+            self.trial_running = False
+
+    def release(self):
+        """
+        End a call that told nothing about the provider (e.g. cancelled), freeing the trial slot.
+        """
+        with self._lock:
+            self.trial_running = False
+
+class LatencyWindow:
+    """
+    Recent successful call latencies, used to pick the hedging deadline.
+    """
+    def __init__(self, size: int = 200, min_samples: int = 20):
+        self.samples = deque(maxlen=size)
+        self.min_samples = min_samples
+        self._lock = threading.Lock()
+
+    def add(self, seconds: float):
+        with self._lock:
+            self.samples.append(seconds)
+
+    def percentile(self, q: float) -> Optional[float]:
+        with self._lock:
+            if len(self.samples) < self.min_samples:
+                return None
+            ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+class Backend:
+    """
+    One configured provider profile with its own scheduler, circuit breaker and latency window.
+    """
+    def __init__(self, profile: str, provider: LLMProvider):
+        self.profile = profile
+        self.provider = provider
+        # The unnamed profile keeps the SCHED_LLM_* settings
+        self.scheduler = get_scheduler("llm" if profile == DEFAULT_PROFILE else f"llm_{profile}")
+        self.breaker = CircuitBreaker(LLM_BREAKER_FAILURES, LLM_BREAKER_COOLDOWN)
+        self.latency = LatencyWindow()
+
+    def hedge_delay(self) -> float:
+        p95 = self.latency.percentile(0.95)
+        return max(LLM_HEDGE_MIN_DELAY, p95) if p95 is not None else LLM_HEDGE_DEFAULT_DELAY
+
+    def stats(self) -> Dict:
+        return {
+            "profile": self.profile,
+            **self.provider.stats(),
+            "breaker": self.breaker.state,
+            "p95": self.latency.percentile(0.95)
+        }
+
+def profile_settings(profile: str) -> Dict[str, Optional[str]]:
+    prefix = "LLM_" if profile == DEFAULT_PROFILE else f"LLM_{profile.upper()}_"
+    return {
+        "provider_type": os.getenv(prefix + "TYPE"),
+        "api_key": os.getenv(prefix + "API_KEY"),
+        "base_url": os.getenv(prefix + "BASE_URL"),
+        "model": os.getenv(prefix + "MODEL"),
+        "api_version": os.getenv(prefix + "API_VERSION")
+    }
+
+_backends: Optional[List[Backend]] = None
+_backends_lock = threading.Lock()
+
+def get_backends() -> List[Backend]:
+    """
+    The configured providers in priority order (LLM_PROVIDERS), built on first use.
+    """
+    global _backends
+    if _backends is None:
+        with _backends_lock:
+            if _backends is None:
+                profiles = [p.strip() for p in os.getenv("LLM_PROVIDERS", "").split(",") if p.strip()]
+                _backends = [
+                    Backend(profile, build_provider(**profile_settings(profile)))
+                    for profile in profiles or [DEFAULT_PROFILE]
+                ]
+    return _backends
+
+def version() -> str:
+    """
+    Part of the cache key of LLM outputs: any configured provider may answer, so all their models count.
+    """
+    profiles = [p.strip() for p in os.getenv("LLM_PROVIDERS", "").split(",") if p.strip()]
+    return ",".join(
+        f"{settings['provider_type']}:{settings['model']}"
+        for settings in map(profile_settings, profiles or [DEFAULT_PROFILE])
+    )
+
+def get_provider() -> LLMProvider:
+    """
+    The primary provider.
+    """
+    return get_backends()[0].provider
+
+def settle_breaker(breaker: CircuitBreaker, future: Future):
+    try:
+        result = future.result()
+    except MalformedJSONError:
+        breaker.record_success()
+    except Exception:
+        breaker.record_failure()
     else:
-        raise ValueError(f"Unsupported LLM type: {llm_type}")
+        if result is None:
+            # Cancelled before answering
+            breaker.release()
+        else:
+            breaker.record_success()
+
+def settle_usage(profile: str, usage: Optional["UsageMeter"]):
+    # An attempt whose answer isn't used is not charged to the user
+    if usage is not None:
+        metrics.record_uncharged_tokens(profile, usage.to_dict())
+
+_hedge_executor = ThreadPoolExecutor(max_workers=LLM_POOL_CONNECTIONS, thread_name_prefix="llm")
+
+def call_hedged(attempt: Callable[[Backend, threading.Event], Optional[str]]) -> str:
+    """
+    Run `attempt` against the providers in order. A provider that fails hands over to the
+    next one immediately; one that is still running past its p95 latency gets the next
+    provider started alongside it, and the first successful answer wins.
+    Providers with an open circuit breaker are skipped unless every breaker is open.
+    Under track_usage() only the winning attempt is charged; the tokens of the others
+    are counted as uncharged in metrics.
+    """
+    backends = get_backends()
+    meter = _usage_meter.get()
+    usages: Dict[Future, UsageMeter] = {}
+    remaining = list(backends)
+    cancelled = threading.Event()
+    pending: Dict[Future, Backend] = {}
+    started: Dict[Future, float] = {}
+    last_error: Optional[Exception] = None
+
+    def start(backend: Backend) -> Backend:
+        context = contextvars.copy_context()
+        # Each attempt meters into its own UsageMeter until it is known to be the one used
+        usage = UsageMeter() if meter is not None else None
+        if usage is not None:
+            context.run(_usage_meter.set, usage)
+        future = _hedge_executor.submit(context.run, attempt, backend, cancelled)
+        if usage is not None:
+            usages[future] = usage
+        pending[future] = backend
+        started[future] = time.monotonic()
+        return backend
+
+    def launch_next() -> Optional[Backend]:
+        while remaining:
+            backend = remaining.pop(0)
+            if backend.breaker.allow():
+                return start(backend)
+        return None
+
+    # With every breaker open, trying the primary beats failing outright
+    newest = launch_next() or start(backends[0])
+    try:
+        while pending:
+            can_hedge = LLM_HEDGE and bool(remaining)
+            done, _ = wait(pending, timeout=newest.hedge_delay() if can_hedge else None, return_when=FIRST_COMPLETED)
+            if not done:
+                print(f"LLM provider {newest.profile} is slow, hedging with the next provider")
+                newest = launch_next() or newest
+                continue
+
+            for future in done:
+                backend = pending.pop(future)
+                usage = usages.pop(future, None)
+                try:
+                    result = future.result()
+                except MalformedJSONError as e:
+                    # A bad answer is not an outage: the provider did respond
+                    last_error = e
+                    backend.breaker.record_success()
+                    settle_usage(backend.profile, usage)
+                    print(f"Malformed response from LLM provider {backend.profile}: {str(e)}")
+                    continue
+                except Exception as e:
+                    last_error = e
+                    backend.breaker.record_failure()
+                    settle_usage(backend.profile, usage)
+                    print(f"LLM provider {backend.profile} failed: {str(e)}")
+                    continue
+                if usage is not None:
+                    meter.merge(usage)
+                backend.breaker.record_success()
+                backend.latency.add(time.monotonic() - started[future])
+                return result
+
+            if not pending:
+                newest = launch_next() or newest
+    finally:
+        # Losing requests stop reading their streams; their outcome still settles their breaker
+        cancelled.set()
+        for future, backend in pending.items():
+            future.add_done_callback(lambda future, breaker=backend.breaker: settle_breaker(breaker, future))
+            future.add_done_callback(
+                lambda future, profile=backend.profile, usage=usages.get(future): settle_usage(profile, usage)
+            )
+
+    raise last_error
+
+class TokenBudgetError(ValueError):
+    pass
+
+class UsageMeter:
+    """
+    Token usage of the LLM calls made within a track_usage() block. Of a hedged call
+    only the attempt whose answer was used counts.
+    """
+    def __init__(self):
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def add(self, usage: Dict[str, int]):
+        with self._lock:
+            self.prompt_tokens += usage.get("prompt_tokens", 0)
+            self.completion_tokens += usage.get("completion_tokens", 0)
+            self.calls += 1
+
+    def merge(self, other: "UsageMeter"):
+        usage = other.to_dict()
+        with self._lock:
+            self.prompt_tokens += usage["prompt_tokens"]
+            self.completion_tokens += usage["completion_tokens"]
+            self.calls += usage["calls"]
+
+    def to_dict(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "calls": self.calls,
+                "prompt_tokens": self.prompt_tokens,
+                "completion_tokens": self.completion_tokens
+            }
+
+_usage_meter: contextvars.ContextVar = contextvars.ContextVar("llm_usage_meter", default=None)
+
+@contextmanager
+def track_usage() -> Iterator[UsageMeter]:
+    """
+    Meter the LLM calls made in this context, including those made from threads it is copied to.
+    """
+    meter = UsageMeter()
+    token = _usage_meter.set(meter)
+    try:
+        yield meter
+    finally:
+        _usage_meter.reset(token)
+
+def build_messages(prompt: Union[str, List[Dict[str, str]]]) -> List[Dict[str, str]]:
+    if not isinstance(prompt, str):
+        return prompt
+    return [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user", "content": prompt},
+    ]
+
+def check_budget(messages: List[Dict[str, str]]) -> int:
+    """
+    Count the input tokens of a call, raising TokenBudgetError above LLM_MAX_INPUT_TOKENS.
+    """
+    tokens = count_message_tokens(messages)
+    if LLM_MAX_INPUT_TOKENS and tokens > LLM_MAX_INPUT_TOKENS:
+        raise TokenBudgetError(f"Prompt has {tokens} tokens, over the budget of {LLM_MAX_INPUT_TOKENS}")
+    return tokens
+
+def call_backend(backend: Backend, call: Callable[[Dict[str, int]], Optional[str]], tokens: int) -> Optional[str]:
+    """
+    Run one request against a backend through its scheduler, timing it and counting its tokens.
+    `call` receives the dict the provider reports usage into; without a report the usage is estimated.
+    """
+    def run() -> Optional[str]:
+        usage: Dict[str, int] = {}
+        with metrics.external_call(f"llm_{backend.profile}", model=backend.provider.model):
+            text = call(usage)
+            estimated = not usage
+            if estimated and text is not None:
+                usage.update(prompt_tokens=tokens, completion_tokens=count_tokens(text))
+            if usage:
+                metrics.record_tokens(backend.profile, usage, estimated=estimated)
+                meter = _usage_meter.get()
+                if meter is not None:
+                    meter.add(usage)
+        return text
+
+    return backend.scheduler.call(run, tokens=tokens)
+
+def llm(prompt: Union[str, List[Dict[str, str]]], timeout: Optional[float] = None) -> str:
+    messages = build_messages(prompt)
+    tokens = check_budget(messages)
+
+    def attempt(backend: Backend, cancelled: threading.Event) -> str:
+        return call_backend(backend, lambda usage: backend.provider.complete(messages, timeout=timeout, usage=usage), tokens)
+
+    return call_hedged(attempt)
+
+def stream_json(provider: LLMProvider, messages: List[Dict[str, str]], timeout: Optional[float] = None,
+                cancelled: Optional[threading.Event] = None, usage: Optional[Dict[str, int]] = None,
+                drain: bool = False) -> Optional[str]:
+    """
+    Stream a completion and return the first top-level JSON object in it.
+    Reading stops as soon as the object closes, or with `drain` once the provider's usage
+    report arrives; malformed output raises MalformedJSONError.
+    Returns None if `cancelled` is set before the object is complete.
+    """
+    scanner = JSONObjectScanner()
+    with closing(provider.stream(messages, timeout=timeout, usage=usage)) as chunks:
+        for chunk in chunks:
+            if cancelled is not None and cancelled.is_set():
+                return None
+            result = scanner.feed(chunk)
+            if result is not None:
+                break
+        else:
+            return scanner.finish()
+        if drain and provider.stream_usage():
+            # The usage report comes after the last of the text
+            for _ in chunks:
+                if usage or (cancelled is not None and cancelled.is_set()):
+                    break
+    return result
+
+def extract_json(text: str) -> str:
+    """
+    The first top-level JSON object of a complete response.
+    """
+    scanner = JSONObjectScanner()
+    return scanner.feed(text) or scanner.finish()
+
+def llm_json(prompt: Union[str, List[Dict[str, str]]], timeout: Optional[float] = None) -> str:
+    """
+    Ask for a JSON answer and return the text of the JSON object.
+    `prompt` is either the user message or the full list of messages (see prompt_builder).
+    Requests are hedged across the configured providers; when every provider answers
+    with malformed JSON the request is retried.
+    """
+    messages = build_messages(prompt)
+    tokens = check_budget(messages)
+
+    def attempt(backend: Backend, cancelled: threading.Event) -> Optional[str]:
+        if not LLM_STREAM:
+            text = call_backend(
+                backend, lambda usage: backend.provider.complete(messages, timeout=timeout, usage=usage), tokens
+            )
+            return extract_json(text)
+        # Users are billed from the provider's usage report, so read on to it when metering
+        drain = _usage_meter.get() is not None
+        return call_backend(
+            backend,
+            lambda usage: stream_json(
+                backend.provider, messages, timeout=timeout, cancelled=cancelled, usage=usage, drain=drain
+            ),
+            tokens
+        )
+
+    for attempt_number in range(LLM_STREAM_RETRIES + 1):
+        try:
+            return call_hedged(attempt)
+        except MalformedJSONError as e:
+            print(f"Malformed LLM response (attempt {attempt_number + 1}): {str(e)}")
+            if attempt_number == LLM_STREAM_RETRIES:
+                raise
+
+def llm_stats() -> List[Dict]:
+    return [backend.stats() for backend in get_backends()]
 
 if __name__ == '__main__':
-    print(llm('hi'))
\ No newline at end of file
+    print(llm('hi'))
+    print(llm_stats())
@@ -1,47 +1,90 @@
 from waitress import serve
-from flask import Flask, request, jsonify, send_file
+from flask import Flask, Response, request, jsonify, send_file, stream_with_context
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.dialects.postgresql import JSONB, JSONPATH
+from sqlalchemy import event, inspect, func, update
+from dataclasses import dataclass
 from flask_cors import CORS
-from flask_jwt_extended import JWTManager, create_access_token, jwt_required, get_jwt_identity
+from flask_jwt_extended import JWTManager, create_access_token, jwt_required, get_jwt_identity, get_jwt
 from werkzeug.security import generate_password_hash, check_password_hash
-from random import randint
-from subprocess import check_output
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta, timezone
-from magika import Magika
 from PIL import Image
+import numpy as np
 import enum
 import hashlib
+import base64
 import jwt
 import os
-from os import remove
 import io
 import re
 import json
-import time
+import orjson
 import shutil
+import uuid
+import zipfile
+import threading
+import queue
+import argparse
+import contextvars
 import requests
 from dotenv import load_dotenv
-from verify import docx_to_json, image_to_json, compare_jsons
+from llm import track_usage, UsageMeter, llm_stats
+from verify import docx_to_json, image_to_json, compare_jsons, docx_to_json_version, image_to_json_version
+from cache import ResultCache, TTLCache, content_key
+from office import OfficePool, ConversionError
+from jobs import Job, JobError, JobQueue, JobStatus, ACTIVE_STATUSES
+from events import EventBus, format_sse
+import migrations
+import models
+import ocr
+from templates import get_templates
+import scheduler
+import metrics
 
 # Load environment variables
 load_dotenv()
 
 # Initialize Flask app
 app = Flask(__name__)
-CORS(app)
+CORS(app, expose_headers=["X-Next-Cursor"])
 
 # Configuration
-app.config['SQLALCHEMY_DATABASE_URI'] = f'postgresql://{os.getenv("DB_USER")}:{os.getenv("DB_PASSWORD")}@{os.getenv("DB_HOST")}:{os.getenv("DB_PORT")}/{os.getenv("DB_NAME")}'
+# DATABASE_URL overrides the DB_* settings, e.g. sqlite:///bench.db for the benchmark
+app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv("DATABASE_URL") or f'postgresql://{os.getenv("DB_USER")}:{os.getenv("DB_PASSWORD")}@{os.getenv("DB_HOST")}:{os.getenv("DB_PORT")}/{os.getenv("DB_NAME")}'
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+    'json_serializer': lambda obj: orjson.dumps(obj).decode(),
+    'json_deserializer': orjson.loads
+}
 app.config['JWT_SECRET_KEY'] = os.getenv("SECRET_KEY")
 app.config['JWT_ACCESS_TOKEN_EXPIRES'] = timedelta(minutes=3000)
+app.config['JWT_TOKEN_LOCATION'] = ['headers']
 
 upload_path = os.getenv("FILES_UPLOAD_PATH")
+batch_max_items = int(os.getenv("BATCH_MAX_ITEMS", "200"))
+batch_max_bytes = int(os.getenv("BATCH_MAX_MB", "500")) * 1024 * 1024
+verifications_page_size = int(os.getenv("VERIFICATIONS_PAGE_SIZE", "50"))
+# "memory" passes decoded arrays from crop to table detection to OCR; "disk" writes each step as PNG
+image_pipeline = os.getenv("IMAGE_PIPELINE", "memory")
+# Credit charged to User.used_credit per 1000 LLM tokens actually used
+llm_prompt_credit = float(os.getenv("LLM_PROMPT_CREDIT_PER_1K", "1"))
+llm_completion_credit = float(os.getenv("LLM_COMPLETION_CREDIT_PER_1K", "1"))
+
+# Global cache of docx_to_json / image_to_json outputs keyed by file content
+result_cache = ResultCache(
+    os.getenv("RESULT_CACHE_PATH", f"{upload_path}/cache"),
+    max_bytes=int(os.getenv("RESULT_CACHE_MAX_MB", "256")) * 1024 * 1024,
+    max_age=float(os.getenv("RESULT_CACHE_MAX_AGE_DAYS", "30")) * 24 * 3600
+)
 
 # Initialize extensions
 db = SQLAlchemy(app)
 jwt = JWTManager(app)
 
+# Stage transitions and partial results of running verifications, for /events
+event_bus = EventBus()
+
 # Enums and Models
 class UserRole(str, enum.Enum):
     ADMIN = "admin"
@@ -56,11 +99,22 @@ class User(db.Model):
     role = db.Column(db.Enum(UserRole))
     used_credit = db.Column(db.Float, default=0)
 
+class Batch(db.Model):
+    __tablename__ = "batches"
+    id = db.Column(db.Integer, primary_key=True)
+    batch_name = db.Column(db.String)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'))
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+# JSONB on Postgres, plain JSON elsewhere
+JSONType = db.JSON().with_variant(JSONB(), "postgresql")
+
 class Verification(db.Model):
     __tablename__ = "verifications"
     id = db.Column(db.Integer, primary_key=True)
     verification_name = db.Column(db.String)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'))
+    batch_id = db.Column(db.Integer, db.ForeignKey('batches.id'), index=True)
     docx_path = db.Column(db.String)
     docx_filename = db.Column(db.String)
     pdf = db.Column(db.Boolean, default=False)
@@ -69,16 +123,62 @@ class Verification(db.Model):
     image_filename = db.Column(db.String)
     image_hash = db.Column(db.String(64))
     image_ocr_scope = db.Column(db.String)
-    docx_json = db.Column(db.String)
-    ocr_json = db.Column(db.String)
-    differences_json = db.Column(db.String)
+    docx_json = db.Column(JSONType)
+    ocr_json = db.Column(JSONType)
+    differences_json = db.Column(JSONType)
     status = db.Column(db.String, default="pending")
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
+    __table_args__ = (
+        db.Index('ix_verifications_user_id_created_at', 'user_id', 'created_at'),
+    )
+
+@dataclass(frozen=True)
+class CurrentUser:
+    """
+    Detached snapshot of the authenticated user, safe to share between requests.
+    """
+    id: int
+    username: str
+    email: str
+    role: UserRole
+    used_credit: float
+
+# Identity of recent callers, so authenticated requests don't each query the users table
+user_cache = TTLCache(
+    max_size=int(os.getenv("USER_CACHE_SIZE", "1024")),
+    ttl=float(os.getenv("USER_CACHE_TTL", "60"))
+)
+
+@event.listens_for(User, 'after_update')
+@event.listens_for(User, 'after_delete')
+def invalidate_cached_user(mapper, connection, target):
+    user_cache.invalidate(target.username)
+    # A renamed user is cached under the old name as well
+    for old_username in inspect(target).attrs.username.history.deleted:
+        user_cache.invalidate(old_username)
+
 # Utility Functions
 def get_current_user():
     username = get_jwt_identity()
-    return User.query.filter_by(username=username).first()
+    current_user = user_cache.get(username)
+    if current_user is None:
+        # Tokens carry the user id, which turns the lookup into a primary key fetch
+        user_id = get_jwt().get("uid")
+        if user_id is not None:
+            user = db.session.get(User, user_id)
+            if user is not None and user.username != username:
+                user = None
+        else:
+            user = User.query.filter_by(username=username).first()
+        if user is None:
+            return None
+        current_user = CurrentUser(user.id, user.username, user.email, user.role, user.used_credit)
+        user_cache.set(username, current_user)
+    return current_user
+
+def load_differences(verification: Verification):
+    return verification.differences_json or None
 
 def calculate_file_hash(content: bytes) -> str:
     return hashlib.sha256(content).hexdigest()
@@ -88,19 +188,20 @@ def process_image(image_content: bytes, image_path: str):
     os.makedirs(os.path.dirname(image_path), exist_ok=True)
     image.save(image_path)
 
+def crop_box(crop_info: str, img_width: int, img_height: int) -> tuple:
+    crop_height, crop_width, crop_x, crop_y = json.loads(crop_info)
+
+    x = max(0, min(round((crop_x / 100) * img_width), img_width - 1))
+    y = max(0, min(round((crop_y / 100) * img_height), img_height - 1))
+    width = max(1, min(round((crop_width / 100) * img_width), img_width - x))
+    height = max(1, min(round((crop_height / 100) * img_height), img_height - y))
+
+    return (x, y, x + width, y + height)
+
 def crop_image(image_path: str, crop_info: str) -> str:
     try:
-        crop_height, crop_width, crop_x, crop_y = json.loads(crop_info)
         img = Image.open(image_path)
-        img_width, img_height = img.size
-
-        x = max(0, min(round((crop_x / 100) * img_width), img_width - 1))
-        y = max(0, min(round((crop_y / 100) * img_height), img_height - 1))
-        width = max(1, min(round((crop_width / 100) * img_width), img_width - x))
-        height = max(1, min(round((crop_height / 100) * img_height), img_height - y))
-
-        crop_box = (x, y, x + width, y + height)
-        cropped_img = img.crop(crop_box)
+        cropped_img = img.crop(crop_box(crop_info, *img.size))
 
         base_name, ext = os.path.splitext(image_path)
         cropped_image_path = f"{base_name}_cropped{ext}"
@@ -110,6 +211,59 @@ def crop_image(image_path: str, crop_info: str) -> str:
     except Exception as e:
         raise RuntimeError(f"Failed to crop image: {str(e)}")
 
+def save_upload(content: bytes, path: str):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as buffer:
+        buffer.write(content)
+
+DOCX_MIME_TYPE = "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
+
+def stage_docx(verification_id: int, filename: str, content: bytes, docx_hash: str) -> dict:
+    """
+    Persist an uploaded DOCX for a job and describe it in the job payload.
+    """
+    docx_ext = os.path.splitext(filename)[1]
+    # Unique per upload, so a failed job can't leave its file where another upload stages
+    docx_tmp_path = f"{upload_path}/docx/{verification_id}_{uuid.uuid4().hex}_tmp{docx_ext}"
+    save_upload(content, docx_tmp_path)
+    return {
+        "tmp_path": docx_tmp_path,
+        "path": f"{upload_path}/docx/{verification_id}{docx_ext}",
+        "filename": filename,
+        "hash": docx_hash
+    }
+
+def stage_image(verification_id: int, filename: str, content: bytes, image_hash: str, ocr_scope: str) -> dict:
+    """
+    Persist an uploaded image for a job and describe it in the job payload.
+    """
+    image_tmp_path = f"{upload_path}/images/{verification_id}_{uuid.uuid4().hex}_tmp.png"
+    if image_pipeline == "memory":
+        # Decoded once by the worker; the upload itself is the stored artifact
+        save_upload(content, image_tmp_path)
+    else:
+        process_image(content, image_tmp_path)
+    return {
+        "tmp_path": image_tmp_path,
+        "path": f"{upload_path}/images/{verification_id}.png",
+        "filename": filename,
+        "hash": image_hash,
+        "ocr_scope": ocr_scope
+    }
+
+def load_image(image_path: str) -> np.ndarray:
+    """
+    Decode an image once into an RGB array for the in-memory pipeline.
+    """
+    return np.array(Image.open(image_path).convert("RGB"))
+
+def crop_array(img: np.ndarray, crop_info: str) -> np.ndarray:
+    try:
+        x_min, y_min, x_max, y_max = crop_box(crop_info, img.shape[1], img.shape[0])
+        return img[y_min:y_max, x_min:x_max]
+    except Exception as e:
+        raise RuntimeError(f"Failed to crop image: {str(e)}")
+
 # Routes
 @app.route('/token', methods=['POST'])
 def login():
@@ -120,7 +274,10 @@ def login():
     if not user or not check_password_hash(user.password, password):
         return jsonify({"error": "Invalid credentials"}), 400
 
-    access_token = create_access_token(identity=username)
+    access_token = create_access_token(
+        identity=username,
+        additional_claims={"uid": user.id}
+    )
     return jsonify(access_token=access_token, token_type="bearer")
 
 @app.route('/users', methods=['POST'])
@@ -156,17 +313,64 @@ def read_user():
         'used_credit': current_user.used_credit
     })
 
+def encode_cursor(created_at: datetime, verification_id: int) -> str:
+    return base64.urlsafe_b64encode(f"{created_at.isoformat()}|{verification_id}".encode()).decode()
+
+def decode_cursor(cursor: str) -> tuple:
+    created_at, verification_id = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+    return datetime.fromisoformat(created_at), int(verification_id)
+
 @app.route('/verifications', methods=['GET'])
 @jwt_required()
 def list_verifications():
     current_user = get_current_user()
-    verifications = Verification.query.filter_by(user_id=current_user.id).all()
-    return jsonify([{
+    limit = min(max(request.args.get('limit', default=verifications_page_size, type=int), 1), 200)
+
+    # Only the listed columns are selected, so the JSON result columns are never loaded
+    query = db.session.query(
+        Verification.id,
+        Verification.verification_name,
+        Verification.status,
+        Verification.created_at
+    ).filter(Verification.user_id == current_user.id)
+
+    status = request.args.get('status')
+    if status:
+        query = query.filter(Verification.status == status)
+
+    name_prefix = request.args.get('name')
+    if name_prefix:
+        query = query.filter(Verification.verification_name.startswith(name_prefix, autoescape=True))
+
+    # e.g. ?differs=原料.content lists verifications whose comparison flagged that field
+    differs = request.args.get('differs')
+    if differs:
+        path = "$.compare_result.differences." + json.dumps(differs, ensure_ascii=False)
+        query = query.filter(Verification.differences_json.op('@?')(db.cast(path, JSONPATH)))
+
+    # Keyset pagination over (created_at, id), newest first
+    cursor = request.args.get('cursor')
+    if cursor:
+        try:
+            cursor_created_at, cursor_id = decode_cursor(cursor)
+        except (ValueError, UnicodeDecodeError):
+            return jsonify({"error": "Invalid cursor"}), 400
+        query = query.filter(
+            db.tuple_(Verification.created_at, Verification.id) < db.tuple_(cursor_created_at, cursor_id)
+        )
+
+    rows = query.order_by(Verification.created_at.desc(), Verification.id.desc()).limit(limit + 1).all()
+    page = rows[:limit]
+
+    response = jsonify([{
         'id': v.id,
         'verification_name': v.verification_name,
         'status': v.status,
         'created_at': v.created_at.isoformat()
-    } for v in verifications])
+    } for v in page])
+    if len(rows) > limit:
+        response.headers['X-Next-Cursor'] = encode_cursor(page[-1].created_at, page[-1].id)
+    return response
 
 @app.route('/verifications', methods=['POST'])
 @jwt_required()
@@ -201,12 +405,7 @@ def get_verification_info(verification_id):
     image_exists = os.path.exists(verification.image_path) if verification.image_path else False
     pdf_exists = os.path.exists(f"{upload_path}/pdf/{verification_id}.pdf") if verification.pdf else False
 
-    differences = None
-    if verification.differences_json:
-        try:
-            differences = eval(verification.differences_json)
-        except Exception as e:
-            differences = {"error": f"Failed to parse differences: {str(e)}"}
+    differences = load_differences(verification)
 
     return jsonify({
         "verification_id": verification.id,
@@ -234,7 +433,6 @@ def get_verification_info(verification_id):
 @app.route('/verifications/<int:verification_id>/upload', methods=['POST'])
 @jwt_required()
 def upload_files(verification_id):
-    time.sleep(10)
     current_user = get_current_user()
     if current_user.role != UserRole.USER:
         return jsonify({"error": "Unauthorized"}), 403
@@ -251,116 +449,523 @@ def upload_files(verification_id):
     if not ((docx_file or verification.docx_path) and (image_file or verification.image_path)):
         return jsonify({"error": "Missing required files"}), 400
 
-    magika = Magika()
+    # Validate the uploads before claiming the verification
+    magika = models.get_magika()
+    docx_content = docx_file.read() if docx_file else None
+    if docx_content is not None and magika.identify_bytes(docx_content).output.mime_type != DOCX_MIME_TYPE:
+        return jsonify({"error": "Invalid DOCX type"}), 400
+    image_content = image_file.read() if image_file else None
+    if image_content is not None and not magika.identify_bytes(image_content).output.mime_type.startswith('image/'):
+        return jsonify({"error": "Invalid image type"}), 400
+
+    # One conditional UPDATE claims it, so of two concurrent uploads only one gets to queue a job
+    previous_status = verification.status
+    current = db.session.execute(
+        update(Verification)
+        .where(Verification.id == verification.id,
+               Verification.status.notin_([status.value for status in ACTIVE_STATUSES]))
+        .values(status=JobStatus.QUEUED.value)
+        .returning(Verification.docx_hash, Verification.image_hash, Verification.image_ocr_scope)
+    ).first()
+    db.session.commit()
+    if current is None:
+        return jsonify({"error": "Verification is already being processed"}), 409
+
+    # Persist the changed uploads; the heavy lifting happens in the job workers
+    payload = {"docx": None, "image": None}
     try:
-        # Process DOCX
-        if docx_file:
-            docx_content = docx_file.read()
+        if docx_content is not None:
             docx_hash = calculate_file_hash(docx_content)
-            
-            if verification.docx_hash != docx_hash:
-                if magika.identify_bytes(docx_content).output.mime_type != "application/vnd.openxmlformats-officedocument.wordprocessingml.document":
-                    return jsonify({"error": "Invalid DOCX type"}), 400
-
-                docx_tmp_path = f"{upload_path}/docx/{verification_id}_tmp{os.path.splitext(docx_file.filename)[1]}"
-                docx_path = f"{upload_path}/docx/{verification_id}{os.path.splitext(docx_file.filename)[1]}"
-                
-                os.makedirs(os.path.dirname(docx_tmp_path), exist_ok=True)
-                with open(docx_tmp_path, "wb") as buffer:
-                    buffer.write(docx_content)
-
-                # Convert DOCX to PDF
-                response = requests.post(
-                    "http://162.38.3.101:8101/doc_to_pdf",
-                    files={'file': open(docx_tmp_path, 'rb')}
-                )
+            if current.docx_hash != docx_hash:
+                payload["docx"] = stage_docx(verification_id, docx_file.filename, docx_content, docx_hash)
 
-                if response.status_code == 200:
-                    pdf_tmp_path = f"{upload_path}/pdf/{verification_id}_tmp.pdf"
-                    pdf_path = f"{upload_path}/pdf/{verification_id}.pdf"
-                    os.makedirs(os.path.dirname(pdf_tmp_path), exist_ok=True)
-                    
-                    with open(pdf_tmp_path, 'wb') as pdf_file:
-                        pdf_file.write(response.content)
-                    verification.pdf = True
-                else:
-                    verification.pdf = False
-
-                docx_json = docx_to_json(pdf_tmp_path)
-                if isinstance(docx_json, dict) and "error" in docx_json:
-                    os.remove(docx_tmp_path)
-                    return jsonify({
-                        "system_component": "docx_processing",
-                        "error_type": docx_json["error"],
-                        "missing_elements": docx_json.get("missing", []),
-                        "guidance": "Required fields are missing in the DOCX document"
-                    }), 200
-
-                shutil.move(docx_tmp_path, docx_path)
-                shutil.move(pdf_tmp_path, pdf_path)
-
-                verification.docx_path = docx_path
-                verification.docx_filename = docx_file.filename
-                verification.docx_json = json.dumps(docx_json, ensure_ascii=False)
-                verification.docx_hash = docx_hash
-
-        # Process Image
-        if image_file:
-            image_content = image_file.read()
+        if image_content is not None:
             image_hash = calculate_file_hash(image_content)
-            
-            if verification.image_hash != image_hash or verification.image_ocr_scope != ocr_scope:
-                if not magika.identify_bytes(image_content).output.mime_type.startswith('image/'):
-                    return jsonify({"error": "Invalid image type"}), 400
-
-                image_path = f"{upload_path}/images/{verification_id}.png"
-                process_image(image_content, image_path)
-
-                if ocr_scope == 'full':
-                    ocr_json = image_to_json(image_path, 'full')
-                else:
-                    crop = crop_image(image_path, ocr_scope)
-                    ocr_json = image_to_json(crop, 'full')
-
-                if ocr_json is None:
-                    return jsonify({
-                        "system_component": "image_processing",
-                        "error_type": "NUTRITION_TABLE_MISSING",
-                        "guidance": "The nutrition table could not be detected in the image."
-                    }), 200
-
-                verification.image_path = image_path
-                verification.image_filename = image_file.filename
-                verification.image_hash = image_hash
-                verification.image_ocr_scope = ocr_scope
-                verification.ocr_json = json.dumps(ocr_json, ensure_ascii=False)
-
-        # Compare if both files are ready
-        if verification.docx_json and verification.ocr_json:
-            differences = compare_jsons(
-                eval(verification.docx_json),
-                eval(verification.ocr_json)
-            )
-            verification.differences_json = str(differences)
-            verification.status = "completed"
-            db.session.commit()
-            return jsonify({
-                "message": "Verification completed",
-                "differences": differences
-            })
+            if current.image_hash != image_hash or current.image_ocr_scope != ocr_scope:
+                payload["image"] = stage_image(verification_id, image_file.filename, image_content, image_hash, ocr_scope)
+    except Exception:
+        discard_uploads(payload)
+        Verification.query.filter_by(id=verification.id).update({"status": previous_status})
+        db.session.commit()
+        raise
+
+    event_bus.reset(verification.id)
+    job = job_queue.submit(verification.id, current_user.id, payload)
+    event_bus.publish(verification.id, "status", {"status": JobStatus.QUEUED.value, "job_id": job.id})
+
+    return jsonify({
+        "message": "Verification queued",
+        "job_id": job.id,
+        "verification_id": verification.id,
+        "status": job.status.value
+    }), 202
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+@jwt_required()
+def get_job(job_id):
+    current_user = get_current_user()
+    job = job_queue.get(job_id) or batch_queue.get(job_id)
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
+
+    if current_user.role != UserRole.ADMIN and job.user_id != current_user.id:
+        return jsonify({"error": "Not authorized"}), 403
+
+    return jsonify(job.to_dict())
+
+@app.route('/scheduler', methods=['GET'])
+@jwt_required()
+def get_scheduler_stats():
+    current_user = get_current_user()
+    if current_user.role != UserRole.ADMIN:
+        return jsonify({"error": "Unauthorized"}), 403
+
+    return jsonify({
+        "schedulers": scheduler.scheduler_stats(),
+        # Per provider profile: breaker state, p95 latency and HTTP connection reuse
+        "llm": llm_stats()
+    })
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    # Prometheus scrape endpoint; keep it off the public network
+    body, content_type = metrics.render()
+    return Response(body, mimetype=content_type)
+
+@app.route('/verifications/<int:verification_id>/events', methods=['GET'])
+# EventSource can't set headers, so this route alone also takes ?jwt=
+@jwt_required(locations=['headers', 'query_string'])
+def verification_events(verification_id):
+    current_user = get_current_user()
+    verification = Verification.query.get_or_404(verification_id)
+
+    if current_user.role != UserRole.ADMIN and verification.user_id != current_user.id:
+        return jsonify({"error": "Not authorized"}), 403
+
+    status = verification.status
+    differences = load_differences(verification)
+    # The stream can stay open for minutes; don't hold a pooled connection for it
+    db.session.close()
+
+    last_event_id = request.headers.get('Last-Event-ID', type=int)
+    subscriber = event_bus.subscribe(verification_id, last_event_id)
+
+    # Nothing is running: report the stored outcome and close
+    if status not in ACTIVE_STATUSES and not event_bus.has_history(verification_id):
+        event_bus.unsubscribe(verification_id, subscriber)
+        summary = {"id": 0, "event": "status", "data": {
+            "status": status,
+            "differences": differences
+        }}
+        return Response(format_sse(summary), mimetype="text/event-stream")
 
+    def stream():
+        try:
+            while True:
+                try:
+                    event = subscriber.get(timeout=15)
+                except queue.Empty:
+                    # Keep-alive comment; also notices clients that went away
+                    yield ": keep-alive\n\n"
+                    continue
+                yield format_sse(event)
+                # The job is over once it settles on a non-active status
+                if event["event"] == "status" and event["data"]["status"] not in ACTIVE_STATUSES:
+                    break
+        finally:
+            event_bus.unsubscribe(verification_id, subscriber)
+
+    return Response(
+        stream_with_context(stream()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+# Batches
+def read_batch_request() -> tuple:
+    """
+    Read a batch either from a zip `archive` holding manifest.json and the files,
+    or from a `manifest` form field plus the files uploaded as `files`.
+    Returns (batch_name, items, files) where files maps file names to contents.
+    """
+    archive = request.files.get('archive')
+    if archive:
+        try:
+            with zipfile.ZipFile(io.BytesIO(archive.read())) as zf:
+                if sum(info.file_size for info in zf.infolist()) > batch_max_bytes:
+                    raise ValueError("Batch archive is too large")
+                files = {info.filename: zf.read(info) for info in zf.infolist() if not info.is_dir()}
+        except zipfile.BadZipFile:
+            raise ValueError("Invalid zip archive")
+        if 'manifest.json' not in files:
+            raise ValueError("manifest.json is missing from the archive")
+        manifest = json.loads(files.pop('manifest.json'))
+    else:
+        manifest = json.loads(request.form.get('manifest') or 'null')
+        files = {f.filename: f.read() for f in request.files.getlist('files')}
+
+    if isinstance(manifest, list):
+        manifest = {"items": manifest}
+    if not isinstance(manifest, dict) or not isinstance(manifest.get("items"), list) or not manifest["items"]:
+        raise ValueError("The manifest must list at least one item")
+
+    items = manifest["items"]
+    if len(items) > batch_max_items:
+        raise ValueError(f"A batch may hold at most {batch_max_items} items")
+    for index, item in enumerate(items):
+        if not isinstance(item, dict) or not item.get("docx") or not item.get("image"):
+            raise ValueError(f"Item {index} needs both a docx and an image")
+        for key in ("docx", "image"):
+            if item[key] not in files:
+                raise ValueError(f"Item {index} refers to a missing file: {item[key]}")
+
+    return manifest.get("name") or f"Batch {datetime.utcnow():%Y-%m-%d %H:%M}", items, files
+
+@app.route('/batches', methods=['POST'])
+@jwt_required()
+def create_batch():
+    current_user = get_current_user()
+    if current_user.role != UserRole.USER:
+        return jsonify({"error": "Unauthorized"}), 403
+
+    try:
+        batch_name, items, files = read_batch_request()
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    # Validate and hash each distinct file once, however many items share it
+    magika = models.get_magika()
+    hashes = {}
+    for item in items:
+        for key in ("docx", "image"):
+            name = item[key]
+            if (key, name) in hashes:
+                continue
+            mime_type = magika.identify_bytes(files[name]).output.mime_type
+            if (key == "docx" and mime_type != DOCX_MIME_TYPE) or (key == "image" and not mime_type.startswith('image/')):
+                return jsonify({"error": f"Invalid {key} type: {name}"}), 400
+            hashes[(key, name)] = calculate_file_hash(files[name])
+
+    batch = Batch(batch_name=batch_name, user_id=current_user.id)
+    db.session.add(batch)
+    db.session.flush()
+
+    verifications = []
+    for index, item in enumerate(items):
+        verification = Verification(
+            verification_name=item.get("name") or f"{batch_name} #{index + 1}",
+            user_id=current_user.id,
+            batch_id=batch.id,
+            status=JobStatus.QUEUED.value
+        )
+        db.session.add(verification)
+        verifications.append(verification)
+    db.session.flush()
+
+    payloads = [{
+        "docx": stage_docx(verification.id, item["docx"], files[item["docx"]], hashes[("docx", item["docx"])]),
+        "image": stage_image(
+            verification.id, item["image"], files[item["image"]],
+            hashes[("image", item["image"])], item.get("ocr_scope") or "full"
+        )
+    } for verification, item in zip(verifications, items)]
+    db.session.commit()
+
+    # Batch jobs run on their own, smaller worker pool so interactive uploads aren't starved
+    for verification, payload in zip(verifications, payloads):
+        event_bus.reset(verification.id)
+        job = batch_queue.submit(verification.id, current_user.id, payload)
+        event_bus.publish(verification.id, "status", {"status": JobStatus.QUEUED.value, "job_id": job.id})
+
+    return jsonify({
+        "batch_id": batch.id,
+        "batch_name": batch.batch_name,
+        "verification_ids": [v.id for v in verifications]
+    }), 202
+
+@app.route('/batches/<int:batch_id>', methods=['GET'])
+@jwt_required()
+def get_batch(batch_id):
+    current_user = get_current_user()
+    batch = Batch.query.get_or_404(batch_id)
+
+    if current_user.role != UserRole.ADMIN and batch.user_id != current_user.id:
+        return jsonify({"error": "Not authorized"}), 403
+
+    items = db.session.query(
+        Verification.id,
+        Verification.verification_name,
+        Verification.status
+    ).filter(Verification.batch_id == batch.id).order_by(Verification.id).all()
+
+    counts = {}
+    for item in items:
+        counts[item.status] = counts.get(item.status, 0) + 1
+
+    if any(counts.get(status.value) for status in ACTIVE_STATUSES):
+        status = "processing"
+    elif counts.get(JobStatus.FAILED.value):
+        status = "failed" if counts[JobStatus.FAILED.value] == len(items) else "partially_failed"
+    else:
+        status = "completed"
+
+    return jsonify({
+        "batch_id": batch.id,
+        "batch_name": batch.batch_name,
+        "created_at": batch.created_at.isoformat(),
+        "status": status,
+        "total": len(items),
+        "counts": counts,
+        "verifications": [{
+            "id": item.id,
+            "verification_name": item.verification_name,
+            "status": item.status
+        } for item in items]
+    })
+
+# Job Processing
+def commit_job_session():
+    with metrics.stage("db_commit"):
         db.session.commit()
-        return jsonify({
-            "message": "Files processed",
-            "status": "pending"
+
+def charge_llm_usage(user_id: int, meter: UsageMeter):
+    usage = meter.to_dict()
+    if not usage["calls"]:
+        return
+    user = db.session.get(User, user_id)
+    if user is None:
+        return
+    credit = (usage["prompt_tokens"] * llm_prompt_credit + usage["completion_tokens"] * llm_completion_credit) / 1000
+    # Added by the database so concurrent jobs of one user don't overwrite each other;
+    # the update also drops the user's cached identity
+    user.used_credit = func.coalesce(User.used_credit, 0) + credit
+    commit_job_session()
+
+def set_job_status(job: Job, status: JobStatus):
+    if not job.advance(status):
+        return
+    # Stages run on helper threads, so use a session of our own
+    with app.app_context():
+        Verification.query.filter_by(id=job.verification_id).update({"status": status.value})
+        commit_job_session()
+    event_bus.publish(job.verification_id, "status", {"status": status.value, "job_id": job.id})
+
+def process_docx_upload(job: Job, docx: dict) -> dict:
+    set_job_status(job, JobStatus.CONVERTING)
+    docx_tmp_path = docx["tmp_path"]
+
+    # Identical documents being processed concurrently (e.g. within a batch) share one run
+    cache_key = content_key("docx_to_json", docx["hash"], docx_to_json_version())
+    docx_json = result_cache.get_or_compute(
+        cache_key,
+        lambda: docx_to_json(docx_tmp_path),
+        cacheable=lambda result: isinstance(result, dict) and "error" not in result
+    )
+    if isinstance(docx_json, dict) and "error" in docx_json:
+        raise JobError({
+            "system_component": "docx_processing",
+            "error_type": docx_json["error"],
+            "missing_elements": docx_json.get("missing", []),
+            "guidance": "Required fields are missing in the DOCX document"
         })
 
+    event_bus.publish(job.verification_id, "docx_json", docx_json)
+
+    # The file is moved into place by run_verification_job; the PDF is only needed for
+    # download, so it is rendered after the job commits
+    return {
+        "pdf": False,
+        "docx_path": docx["path"],
+        "docx_filename": docx["filename"],
+        "docx_json": docx_json,
+        "docx_hash": docx["hash"]
+    }
+
+def process_image_upload(job: Job, image: dict) -> dict:
+    image_tmp_path = image["tmp_path"]
+    ocr_scope = image["ocr_scope"]
+
+    def on_stage(stage: str):
+        set_job_status(job, JobStatus(stage))
+
+    def compute():
+        if image_pipeline == "memory":
+            img = load_image(image_tmp_path)
+            if ocr_scope != 'full':
+                img = crop_array(img, ocr_scope)
+            return image_to_json(img, 'full', on_stage)
+        if ocr_scope == 'full':
+            return image_to_json(image_tmp_path, 'full', on_stage)
+        crop = crop_image(image_tmp_path, ocr_scope)
+        try:
+            return image_to_json(crop, 'full', on_stage)
+        finally:
+            os.remove(crop)
+
+    # Identical images being processed concurrently (e.g. within a batch) share one run
+    cache_key = content_key("image_to_json", image["hash"], ocr_scope, image_to_json_version())
+    ocr_json = result_cache.get_or_compute(cache_key, compute)
+
+    if ocr_json is None:
+        raise JobError({
+            "system_component": "image_processing",
+            "error_type": "NUTRITION_TABLE_MISSING",
+            "guidance": "The nutrition table could not be detected in the image."
+        })
+
+    event_bus.publish(job.verification_id, "ocr_json", ocr_json)
+
+    return {
+        "image_path": image["path"],
+        "image_filename": image["filename"],
+        "image_hash": image["hash"],
+        "image_ocr_scope": ocr_scope,
+        "ocr_json": ocr_json
+    }
+
+def place_uploads(payload: dict):
+    """
+    Move a job's staged files over the verification's current ones.
+    """
+    for upload in (payload["docx"], payload["image"]):
+        if upload:
+            shutil.move(upload["tmp_path"], upload["path"])
+
+def discard_uploads(payload: dict):
+    for upload in (payload["docx"], payload["image"]):
+        if upload and os.path.exists(upload["tmp_path"]):
+            os.remove(upload["tmp_path"])
+
+def run_verification_job(job: Job) -> dict:
+    with app.app_context(), track_usage() as llm_usage:
+        try:
+            # DOCX and image processing are independent, so let them overlap
+            updates = {}
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                futures = []
+                if job.payload["docx"]:
+                    futures.append(executor.submit(contextvars.copy_context().run, process_docx_upload, job, job.payload["docx"]))
+                if job.payload["image"]:
+                    futures.append(executor.submit(contextvars.copy_context().run, process_image_upload, job, job.payload["image"]))
+                for future in futures:
+                    updates.update(future.result())
+
+            # Only once both branches succeeded, so a failed job leaves the current files as they are
+            place_uploads(job.payload)
+            verification = db.session.get(Verification, job.verification_id)
+            for key, value in updates.items():
+                setattr(verification, key, value)
+            if job.payload["docx"]:
+                commit_job_session()
+                schedule_pdf(verification.id, verification.docx_path, verification.docx_hash)
+
+            # Compare if both files are ready
+            if verification.docx_json and verification.ocr_json:
+                set_job_status(job, JobStatus.COMPARING)
+                with metrics.stage("compare"):
+                    differences = compare_jsons(verification.docx_json, verification.ocr_json)
+                verification.differences_json = differences
+                verification.status = JobStatus.COMPLETED.value
+                commit_job_session()
+                event_bus.publish(job.verification_id, "differences", differences)
+                event_bus.publish(job.verification_id, "status", {"status": JobStatus.COMPLETED.value, "job_id": job.id})
+                return {
+                    "message": "Verification completed",
+                    "differences": differences
+                }
+
+            verification.status = "pending"
+            commit_job_session()
+            event_bus.publish(job.verification_id, "status", {"status": "pending", "job_id": job.id})
+            return {
+                "message": "Files processed",
+                "status": "pending"
+            }
+
+        except Exception as e:
+            discard_uploads(job.payload)
+            db.session.rollback()
+            Verification.query.filter_by(id=job.verification_id).update({"status": JobStatus.FAILED.value})
+            commit_job_session()
+            event_bus.publish(job.verification_id, "status", {
+                "status": JobStatus.FAILED.value,
+                "job_id": job.id,
+                "error": e.payload if isinstance(e, JobError) else {"error": str(e)}
+            })
+            raise
+        finally:
+            # Tokens spent on a failed job are charged too
+            try:
+                charge_llm_usage(job.user_id, llm_usage)
+            except Exception as e:
+                db.session.rollback()
+                print(f"Recording LLM usage failed for job {job.id}: {str(e)}")
+
+def run_batch_job(job: Job) -> dict:
+    # Batch work only gets OCR/LLM capacity that interactive uploads are not waiting for
+    with scheduler.priority(scheduler.BATCH):
+        return run_verification_job(job)
+
+job_queue = JobQueue(run_verification_job, workers=int(os.getenv("JOB_WORKERS", "2")))
+batch_queue = JobQueue(run_batch_job, workers=int(os.getenv("BATCH_WORKERS", "2")), name="batch")
+
+# PDF Generation
+pdf_executor = ThreadPoolExecutor(max_workers=int(os.getenv("PDF_WORKERS", "1")), thread_name_prefix="pdf")
+# DOCX hash being rendered per verification, and the render to run after it when the DOCX changed meanwhile
+pdf_in_progress = {}
+pdf_rerender = {}
+pdf_lock = threading.Lock()
+
+def convert_to_pdf(docx_path: str) -> bytes:
+    # A remote /doc_to_pdf host can be used instead of the local LibreOffice pool
+    doc_to_pdf_url = os.getenv("DOC_TO_PDF_URL")
+    with open(docx_path, 'rb') as docx_content:
+        if not doc_to_pdf_url:
+            with metrics.external_call("libreoffice"):
+                return get_office_pool().convert(docx_content.read(), os.path.basename(docx_path))
+        with metrics.external_call("doc_to_pdf"):
+            response = requests.post(doc_to_pdf_url, files={'file': docx_content})
+    response.raise_for_status()
+    return response.content
+
+def generate_pdf(verification_id: int, docx_path: str, docx_hash: str):
+    try:
+        pdf = convert_to_pdf(docx_path)
+        pdf_tmp_path = f"{upload_path}/pdf/{verification_id}_tmp.pdf"
+        os.makedirs(os.path.dirname(pdf_tmp_path), exist_ok=True)
+        with open(pdf_tmp_path, 'wb') as pdf_file:
+            pdf_file.write(pdf)
+        shutil.move(pdf_tmp_path, f"{upload_path}/pdf/{verification_id}.pdf")
+
+        with app.app_context():
+            # Only mark it ready if the DOCX wasn't replaced in the meantime
+            Verification.query.filter_by(id=verification_id, docx_hash=docx_hash).update({"pdf": True})
+            db.session.commit()
     except Exception as e:
-        if 'docx_path' in locals() and os.path.exists(docx_path):
-            os.remove(docx_path)
-        if 'image_path' in locals() and os.path.exists(image_path):
-            os.remove(image_path)
-        return jsonify({"error": str(e)}), 500
+        print(f"PDF generation failed for verification {verification_id}: {str(e)}")
+    finally:
+        with pdf_lock:
+            rerender = pdf_rerender.pop(verification_id, None)
+            if rerender:
+                pdf_in_progress[verification_id] = rerender[1]
+            else:
+                del pdf_in_progress[verification_id]
+        if rerender:
+            pdf_executor.submit(generate_pdf, verification_id, *rerender)
+
+def schedule_pdf(verification_id: int, docx_path: str, docx_hash: str) -> bool:
+    """
+    Render the verification's PDF in the background; returns False if it is already being rendered.
+    A different DOCX requested mid-render is rendered once the current render finishes.
+    """
+    with pdf_lock:
+        if verification_id in pdf_in_progress:
+            if pdf_in_progress[verification_id] != docx_hash:
+                pdf_rerender[verification_id] = (docx_path, docx_hash)
+            return False
+        pdf_in_progress[verification_id] = docx_hash
+    pdf_executor.submit(generate_pdf, verification_id, docx_path, docx_hash)
+    return True
 
 @app.route('/verifications/<int:verification_id>/docx', methods=['GET'])
 @jwt_required()
@@ -379,7 +984,7 @@ def download_docx(verification_id):
 
     return send_file(
         verification.docx_path,
-        mimetype="application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+        mimetype=DOCX_MIME_TYPE,
         as_attachment=True,
         download_name=verification.docx_filename
     )
@@ -393,12 +998,12 @@ def download_pdf(verification_id):
         user_id=current_user.id
     ).first_or_404()
 
-    if not verification.pdf:
-        return jsonify({"error": "PDF file not found"}), 404
-
     pdf_path = f"{upload_path}/pdf/{verification_id}.pdf"
-    if not os.path.exists(pdf_path):
-        return jsonify({"error": "File no longer exists on server"}), 404
+    if not verification.pdf or not os.path.exists(pdf_path):
+        if not verification.docx_path or not os.path.exists(verification.docx_path):
+            return jsonify({"error": "PDF file not found"}), 404
+        schedule_pdf(verification.id, verification.docx_path, verification.docx_hash)
+        return jsonify({"message": "PDF is being generated"}), 202
 
     return send_file(
         pdf_path,
@@ -490,11 +1095,6 @@ def upload_file():
         </form>
         '''
 
-    filename = randint(0,1000)
-    filename = {
-        'docx': f'{filename}.docx',
-        'pdf': f'{filename}.pdf'
-    }
     if 'file' not in request.files:
         resp = jsonify({'message' : 'No file part in the request'})
         resp.status_code = 400
@@ -504,15 +1104,35 @@ def upload_file():
         resp = resp = jsonify({'message' : 'No file selected for uploading'})
         resp.status_code = 400
         return resp
-    if file and request.method == 'POST':
-        try:
-            file.save(filename["docx"])
-            check_output(['libreoffice', '--headless', '--convert-to', 'pdf' , filename["docx"]])
-            return send_file(filename["pdf"], download_name=filename["pdf"])
-        except Exception as e:
-            return str(e)
-        finally:
-            for key in filename: remove(filename[key])
+    try:
+        pdf = get_office_pool().convert(file.read(), file.filename)
+    except ConversionError as e:
+        resp = jsonify({'message' : str(e)})
+        resp.status_code = 500
+        return resp
+    return send_file(
+        io.BytesIO(pdf),
+        mimetype="application/pdf",
+        download_name=f"{os.path.splitext(file.filename)[0]}.pdf"
+    )
+
+_office_pool = None
+_office_pool_lock = threading.Lock()
+
+def get_office_pool() -> OfficePool:
+    """
+    The LibreOffice worker pool behind /doc_to_pdf, started on first use.
+    """
+    global _office_pool
+    if _office_pool is None:
+        with _office_pool_lock:
+            if _office_pool is None:
+                _office_pool = OfficePool(
+                    size=int(os.getenv("OFFICE_POOL_SIZE", "2")),
+                    max_jobs=int(os.getenv("OFFICE_MAX_JOBS", "50")),
+                    timeout=float(os.getenv("OFFICE_TIMEOUT", "60"))
+                )
+    return _office_pool
 
 def create_default_users():
     if not User.query.first():
@@ -538,9 +1158,26 @@ def create_default_users():
 def init_app():
     with app.app_context():
         db.create_all()
+        migrations.upgrade(db.engine)
         create_default_users()
+        # Jobs live in memory, so anything left in flight by a previous process is lost
+        Verification.query.filter(
+            Verification.status.in_([status.value for status in ACTIVE_STATUSES])
+        ).update({"status": JobStatus.FAILED.value}, synchronize_session=False)
+        db.session.commit()
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--preload', action='store_true',
+                        help="load the table detection, file type and local OCR models before serving")
+    args = parser.parse_args()
+
     init_app()
+    # Read prompts and schemas before the first request needs them
+    get_templates()
+    if args.preload:
+        models.warmup()
+        ocr.warmup()
     print('SERVER STARTING')
-    serve(app, host=os.getenv("SERVER_HOST"), port=os.getenv("SERVER_PORT"))
+    # Each open /events stream holds a thread, so allow more than waitress' default of 4
+    serve(app, host=os.getenv("SERVER_HOST"), port=os.getenv("SERVER_PORT"), threads=int(os.getenv("SERVER_THREADS", "16")))
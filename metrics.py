@@ -0,0 +1,116 @@
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, Tuple
+
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
+
+# Spans are only recorded when OpenTelemetry is installed; exporters are configured
+# the usual way (e.g. opentelemetry-instrument with OTEL_* environment variables).
+try:
+    from opentelemetry import trace
+    tracer = trace.get_tracer("hunyaproof")
+except ImportError:
+    tracer = None
+
+# Pipeline stages run from seconds to minutes
+STAGE_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300)
+
+STAGE_SECONDS = Histogram(
+    "verification_stage_seconds", "Time spent in a step of the verification pipeline",
+    ["stage"], buckets=STAGE_BUCKETS
+)
+JOB_STATUS_SECONDS = Histogram(
+    "verification_job_status_seconds", "Time a job spent in each status",
+    ["queue", "status"], buckets=STAGE_BUCKETS
+)
+QUEUE_WAIT_SECONDS = Histogram(
+    "job_queue_wait_seconds", "Time between a job being queued and a worker picking it up",
+    ["queue"], buckets=STAGE_BUCKETS
+)
+QUEUE_DEPTH = Gauge("job_queue_depth", "Jobs waiting for a worker", ["queue"])
+JOBS_TOTAL = Counter("verification_jobs_total", "Finished verification jobs", ["queue", "status"])
+
+EXTERNAL_SECONDS = Histogram(
+    "external_request_seconds", "Latency of calls to external dependencies",
+    ["dependency", "outcome"], buckets=STAGE_BUCKETS
+)
+EXTERNAL_IN_FLIGHT = Gauge("external_requests_in_flight", "Calls to external dependencies in progress", ["dependency"])
+
+OCR_FALLBACKS = Counter("ocr_fallbacks_total", "OCR calls answered by the fallback engine while throttled", ["primary", "fallback"])
+
+RULE_EXTRACTIONS = Counter(
+    "rule_extractions_total", "Rule-based field extraction by prompt; complete ones skip the LLM",
+    ["prompt", "outcome"]
+)
+
+LLM_TOKENS = Counter(
+    "llm_tokens_total", "LLM tokens by provider profile; source is usage when reported by the provider, else estimated",
+    ["provider", "kind", "source"]
+)
+LLM_UNCHARGED_TOKENS = Counter(
+    "llm_uncharged_tokens_total", "Tokens of metered LLM attempts whose answer was not used (lost hedges, failures)",
+    ["provider", "kind"]
+)
+
+@contextmanager
+def span(name: str, **attributes) -> Iterator[None]:
+    if tracer is None:
+        yield
+        return
+    with tracer.start_as_current_span(name, attributes={k: v for k, v in attributes.items() if v is not None}):
+        yield
+
+@contextmanager
+def stage(name: str, **attributes) -> Iterator[None]:
+    """
+    Time an in-process step of the pipeline (table detection, comparison, DB commits...).
+    """
+    started = time.perf_counter()
+    try:
+        with span(name, **attributes):
+            yield
+    finally:
+        STAGE_SECONDS.labels(name).observe(time.perf_counter() - started)
+
+@contextmanager
+def external_call(dependency: str, **attributes) -> Iterator[None]:
+    """
+    Time a call to an external dependency and count it as in flight while it runs.
+    """
+    in_flight = EXTERNAL_IN_FLIGHT.labels(dependency)
+    in_flight.inc()
+    started = time.perf_counter()
+    outcome = "error"
+    try:
+        with span(dependency, **attributes):
+            yield
+        outcome = "ok"
+    finally:
+        in_flight.dec()
+        EXTERNAL_SECONDS.labels(dependency, outcome).observe(time.perf_counter() - started)
+
+def record_tokens(provider: str, usage: Dict[str, int], estimated: bool = False):
+    source = "estimated" if estimated else "usage"
+    LLM_TOKENS.labels(provider, "prompt", source).inc(usage.get("prompt_tokens", 0))
+    LLM_TOKENS.labels(provider, "completion", source).inc(usage.get("completion_tokens", 0))
+    if tracer is not None:
+        current = trace.get_current_span()
+        current.set_attribute("llm.prompt_tokens", usage.get("prompt_tokens", 0))
+        current.set_attribute("llm.completion_tokens", usage.get("completion_tokens", 0))
+
+def record_uncharged_tokens(provider: str, usage: Dict[str, int]):
+    LLM_UNCHARGED_TOKENS.labels(provider, "prompt").inc(usage.get("prompt_tokens", 0))
+    LLM_UNCHARGED_TOKENS.labels(provider, "completion").inc(usage.get("completion_tokens", 0))
+
+def observe_job(queue: str, job) -> None:
+    """
+    Record a finished job: its queue wait and the time it spent in each status.
+    """
+    if job.started_at is not None:
+        QUEUE_WAIT_SECONDS.labels(queue).observe(job.started_at - job.created_at)
+    for (status, at), (_, following_at) in zip(job.history, job.history[1:]):
+        JOB_STATUS_SECONDS.labels(queue, status.value).observe(following_at - at)
+    JOBS_TOTAL.labels(queue, job.status.value).inc()
+
+def render() -> Tuple[bytes, str]:
+    return generate_latest(), CONTENT_TYPE_LATEST
@@ -0,0 +1,77 @@
+import ast
+import json
+from sqlalchemy import text
+
+# Columns that used to be stored as text and are now JSONB
+JSON_COLUMNS = ["docx_json", "ocr_json", "differences_json"]
+
+def column_type(connection, table: str, column: str) -> str:
+    return connection.execute(text(
+        "SELECT data_type FROM information_schema.columns WHERE table_name = :table AND column_name = :column"
+    ), {"table": table, "column": column}).scalar()
+
+def parse_legacy_json(value: str):
+    """
+    Older rows hold json.dumps output, except differences_json which was written with str(dict).
+    """
+    try:
+        return json.loads(value)
+    except ValueError:
+        return ast.literal_eval(value)
+
+def migrate_json_columns(connection):
+    for column in JSON_COLUMNS:
+        if column_type(connection, "verifications", column) == "jsonb":
+            continue
+
+        # Rewrite every value as real JSON text first, then switch the column type
+        rows = connection.execute(text(
+            f"SELECT id, {column} FROM verifications WHERE {column} IS NOT NULL"
+        )).fetchall()
+        for row_id, value in rows:
+            try:
+                converted = json.dumps(parse_legacy_json(value), ensure_ascii=False) if value.strip() else None
+            except (ValueError, SyntaxError):
+                print(f"Dropping unparseable {column} of verification {row_id}")
+                converted = None
+            connection.execute(text(
+                f"UPDATE verifications SET {column} = :value WHERE id = :id"
+            ), {"value": converted, "id": row_id})
+
+        connection.execute(text(
+            f"ALTER TABLE verifications ALTER COLUMN {column} TYPE JSONB USING {column}::jsonb"
+        ))
+        print(f"Migrated verifications.{column} to JSONB")
+
+    # Serves containment and jsonpath (@>, @?) queries over the comparison results
+    connection.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_verifications_differences_json "
+        "ON verifications USING GIN (differences_json jsonb_path_ops)"
+    ))
+
+def add_columns(connection):
+    # Verifications created through POST /batches belong to a batch
+    connection.execute(text(
+        "ALTER TABLE verifications ADD COLUMN IF NOT EXISTS batch_id INTEGER REFERENCES batches (id)"
+    ))
+    connection.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_verifications_batch_id ON verifications (batch_id)"
+    ))
+
+def create_indexes(connection):
+    # Backs the per-user, newest-first verification listing
+    connection.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_verifications_user_id_created_at "
+        "ON verifications (user_id, created_at)"
+    ))
+
+def upgrade(engine):
+    """
+    Bring an existing database up to the current models. Safe to run on every start.
+    """
+    if engine.dialect.name != "postgresql":
+        return
+    with engine.begin() as connection:
+        migrate_json_columns(connection)
+        add_columns(connection)
+        create_indexes(connection)
@@ -0,0 +1,129 @@
+import os
+import re
+import threading
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+
+class ModelRegistry:
+    """
+    Heavy models (ONNX sessions and the like) by name, each built once per process on
+    first use and then shared by every thread.
+    """
+    def __init__(self):
+        self._factories: Dict[str, Callable[[], Any]] = {}
+        self._warmups: Dict[str, Callable[[Any], None]] = {}
+        self._instances: Dict[str, Any] = {}
+        self._locks: Dict[str, threading.Lock] = {}
+        self._preload: List[str] = []
+
+    def register(self, name: str, factory: Callable[[], Any], warmup: Optional[Callable[[Any], None]] = None,
+                 preload: bool = True):
+        """
+        Models registered with preload=False (optional engines) are only warmed up when named.
+        """
+        self._factories[name] = factory
+        self._locks[name] = threading.Lock()
+        if warmup is not None:
+            self._warmups[name] = warmup
+        if preload:
+            self._preload.append(name)
+
+    def get(self, name: str) -> Any:
+        instance = self._instances.get(name)
+        if instance is None:
+            with self._locks[name]:
+                instance = self._instances.get(name)
+                if instance is None:
+                    instance = self._instances[name] = self._factories[name]()
+        return instance
+
+    def warmup(self, names: Optional[Iterable[str]] = None):
+        """
+        Build the given models (all preloaded ones by default) and run a first inference on
+        each, so that later requests, and processes forked from this one, start with them ready.
+        """
+        for name in names or list(self._preload):
+            instance = self.get(name)
+            if name in self._warmups:
+                self._warmups[name](instance)
+            print(f"Model {name} ready")
+
+    def loaded(self) -> list:
+        return list(self._instances)
+
+def build_table_detector():
+    from rapid_table_det.inference import TableDetector
+    return TableDetector()
+
+def warm_table_detector(detector):
+    import numpy as np
+    detector(np.full((64, 64, 3), 255, dtype=np.uint8))
+
+def build_rapidocr():
+    from rapidocr_onnxruntime import RapidOCR
+    # Extra engine settings, e.g. OCR_LOCAL_THREADS for onnxruntime's intra-op threads
+    settings = {}
+    if os.getenv("OCR_LOCAL_THREADS"):
+        settings["intra_op_num_threads"] = int(os.getenv("OCR_LOCAL_THREADS"))
+    return RapidOCR(**settings)
+
+def warm_rapidocr(engine):
+    import numpy as np
+    engine(np.full((64, 256, 3), 255, dtype=np.uint8))
+
+def build_magika():
+    from magika import Magika
+    return Magika()
+
+def warm_magika(magika):
+    magika.identify_bytes(b"warmup")
+
+class HeuristicTokenizer:
+    """
+    Token estimate without a vocabulary: one token per CJK character, one per four other characters.
+    """
+    CJK = re.compile(r"[\u3000-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uff00-\uffef]")
+
+    def count(self, text: str) -> int:
+        cjk = len(self.CJK.findall(text))
+        return cjk + (len(text) - cjk + 3) // 4
+
+class TiktokenTokenizer:
+    def __init__(self, encoding):
+        self.encoding = encoding
+
+    def count(self, text: str) -> int:
+        return len(self.encoding.encode(text, disallowed_special=()))
+
+def build_tokenizer():
+    # tiktoken is optional, and its vocabulary is downloaded on first use
+    try:
+        import tiktoken
+        return TiktokenTokenizer(tiktoken.get_encoding(os.getenv("LLM_TOKENIZER", "cl100k_base")))
+    except Exception as e:
+        print(f"Counting tokens heuristically: {str(e)}")
+        return HeuristicTokenizer()
+
+def warm_tokenizer(tokenizer):
+    tokenizer.count("warmup")
+
+registry = ModelRegistry()
+registry.register("table_detector", build_table_detector, warm_table_detector)
+registry.register("magika", build_magika, warm_magika)
+registry.register("tokenizer", build_tokenizer, warm_tokenizer)
+registry.register("rapidocr", build_rapidocr, warm_rapidocr, preload=False)
+
+def get_table_detector():
+    return registry.get("table_detector")
+
+def get_magika():
+    return registry.get("magika")
+
+def get_tokenizer():
+    return registry.get("tokenizer")
+
+def get_rapidocr():
+    return registry.get("rapidocr")
+
+def warmup(names: Optional[Iterable[str]] = None):
+    registry.warmup(names)
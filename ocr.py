@@ -1,23 +1,125 @@
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from PIL import Image
-from typing import Dict, Union, BinaryIO, Union, Tuple
+import numpy as np
+import cv2
+import io
+from typing import Dict, List, Union, BinaryIO, Union, Tuple, Optional
+from dataclasses import dataclass
 import json
 import os
+import threading
+import multiprocessing
+from concurrent.futures import Executor, ThreadPoolExecutor, ProcessPoolExecutor
 from dotenv import load_dotenv
+from scheduler import get_scheduler, RateLimitedError, is_rate_limited
+import metrics
+import models
 
 # Load environment variables from .env file
 load_dotenv()
 
-class AzureOCRClient:
-    def __init__(self, endpoint: str, subscription_key: str):
+# "azure" (Image Analysis) or "local" (RapidOCR on the CPU)
+OCR_BACKEND = os.getenv("OCR_BACKEND", "azure")
+# "local" answers from the local engine while Azure is throttled instead of waiting it out
+OCR_FALLBACK = os.getenv("OCR_FALLBACK", "")
+OCR_LOCAL_WORKERS = int(os.getenv("OCR_LOCAL_WORKERS", "2"))
+OCR_LOCAL_POOL = os.getenv("OCR_LOCAL_POOL", "thread")
+OCR_LOCAL_MIN_SCORE = float(os.getenv("OCR_LOCAL_MIN_SCORE", "0.5"))
+
+ImageInput = Union[bytes, np.ndarray]
+
+@dataclass
+class OCRLine:
+    """
+    One recognised line of text with its bounding polygon as (x, y) points.
+    """
+    __slots__ = ('text', 'polygon')
+    text: str
+    polygon: List[Tuple[float, float]]
+
+@dataclass
+class OCRResult:
+    __slots__ = ('lines',)
+    lines: List[OCRLine]
+
+    @classmethod
+    def from_response(cls, data: Dict) -> "OCRResult":
+        """
+        Build from an Image Analysis response (readResult.blocks[].lines[]).
+        """
+        read_result = data.get('readResult') or {}
+        return cls([
+            OCRLine(line['text'], [(point['x'], point['y']) for point in line['boundingPolygon']])
+            for block in read_result.get('blocks', [])
+            for line in block.get('lines', [])
+        ])
+
+    def to_dict(self) -> Dict:
+        return {"readResult": {"blocks": [{"lines": [
+            {"text": line.text, "boundingPolygon": [{"x": x, "y": y} for x, y in line.polygon]}
+            for line in self.lines
+        ]}]}}
+
+class OCRBackend:
+    """
+    An OCR engine answering in the Image Analysis shape (readResult.blocks[].lines[] with
+    text and boundingPolygon), which OCRResult.from_response reads.
+    """
+    name = "base"
+    # Whether recognize_batch does better than one recognize call per image
+    batched = False
+
+    def recognize(self, image: ImageInput) -> Dict:
+        """
+        OCR one image, given as encoded bytes or an RGB array.
+        """
+        raise NotImplementedError
+
+    def recognize_batch(self, images: List[ImageInput]) -> List[Dict]:
+        return [self.recognize(image) for image in images]
+
+class AzureOCRClient(OCRBackend):
+    name = "azure"
+
+    def __init__(
+        self,
+        endpoint: str,
+        subscription_key: str,
+        connect_timeout: float = 5,
+        read_timeout: float = 60,
+        max_retries: int = 5,
+        backoff_factor: float = 0.5,
+        pool_size: int = 10
+    ):
         self.endpoint = endpoint.rstrip('/')
         self.subscription_key = subscription_key
+        self.timeout = (connect_timeout, read_timeout)
+
+        # One long-lived session so OCR calls reuse TLS connections.
+        # 5xx responses are retried with exponential backoff; 429s are left to the
+        # scheduler so they also shrink its concurrency limit.
+        retry = Retry(
+            total=max_retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=(500, 502, 503, 504),
+            allowed_methods=frozenset(["POST"]),
+            respect_retry_after_header=True,
+            raise_on_status=False
+        )
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
 
     def recognize_text(
         self,
         image: Union[str, bytes, BinaryIO],
         detect_orientation: bool = True,
-        language: str = 'zh-Hant'
+        language: str = 'zh-Hant',
+        strip_words: bool = True,
+        retries: Optional[int] = None
     ) -> Dict:
         url = f"{self.endpoint}/computervision/imageanalysis:analyze?features=read&model-version=latest&language=en&gender-neutral-caption=false&api-version=2023-10-01"
         params = {
@@ -37,17 +139,38 @@ class AzureOCRClient:
         else:
             image_data = image.read()
 
+        def send():
+            with metrics.external_call("azure_ocr", bytes=len(image_data)):
+                response = self.session.post(url, headers=headers, params=params, data=image_data, timeout=self.timeout)
+            if response.status_code == 429:
+                try:
+                    retry_after = float(response.headers.get('Retry-After'))
+                except (TypeError, ValueError):
+                    retry_after = None
+                raise RateLimitedError("Azure OCR rate limit exceeded", retry_after)
+            return response
+
+        response = None
         try:
-            response = requests.post(url, headers=headers, params=params, data=image_data)
+            response = get_scheduler("azure_ocr").call(send, retries=retries)
             response.raise_for_status()
             result = response.json()
-            return self.remove_words_objects(result)
+            return self.remove_words_objects(result) if strip_words else result
         except requests.exceptions.RequestException as e:
-            if response.content:
-                error_detail = response.json()
+            if response is not None and response.content:
+                try:
+                    error_detail = response.json()
+                    error_detail = error_detail.get('error', error_detail)
+                except ValueError:
+                    error_detail = {}
                 raise Exception(f"Azure OCR API Error: {error_detail.get('message', str(e))}")
             raise Exception(f"Failed to recognize text: {str(e)}")
 
+    def recognize(self, image: ImageInput, retries: Optional[int] = None) -> Dict:
+        # Only lines are used, so the per-word objects are skipped rather than stripped
+        image_data = encode_png(image) if isinstance(image, np.ndarray) else image
+        return self.recognize_text(image_data, strip_words=False, retries=retries)
+
     def remove_words_objects(self, data: Dict) -> Dict:
         if isinstance(data, dict):
             return {k: self.remove_words_objects(v) for k, v in data.items() if k != "words"}
@@ -70,41 +193,193 @@ class AzureOCRClient:
         
         return '\n\n'.join(text_blocks)
 
-def process_image(image_path: str, scope: Union[Tuple[int, int, int, int], str] = "full"):
+def run_local_ocr(image: np.ndarray) -> List[Tuple[List[List[float]], str, float]]:
+    """
+    RapidOCR on a BGR array: (box, text, score) per detected line. Module level so that
+    process pool workers can run it; each process loads its own engine.
+    """
+    result, _ = models.get_rapidocr()(image)
+    return result or []
+
+class LocalOCREngine(OCRBackend):
+    """
+    RapidOCR (ONNX Runtime, CPU) behind a pool of OCR_LOCAL_WORKERS threads or processes.
+    A batch is spread over the pool; within an image the engine batches its text lines
+    through the recogniser.
+    """
+    name = "local"
+    batched = True
+
+    def __init__(self, workers: int = 2, pool: str = "thread", min_score: float = 0.5):
+        self.min_score = min_score
+        self.executor: Executor
+        if pool == "process":
+            # Spawned, not forked, so workers don't inherit the server's threads and locks
+            self.executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+        else:
+            self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ocr")
+
+    @staticmethod
+    def to_bgr(image: ImageInput) -> np.ndarray:
+        if isinstance(image, np.ndarray):
+            return cv2.cvtColor(image, cv2.COLOR_RGB2BGR)
+        decoded = cv2.imdecode(np.frombuffer(image, dtype=np.uint8), cv2.IMREAD_COLOR)
+        if decoded is None:
+            raise ValueError("Failed to decode image")
+        return decoded
+
+    def to_response(self, lines: List[Tuple[List[List[float]], str, float]], image: np.ndarray) -> Dict:
+        height, width = image.shape[:2]
+        return {
+            "modelVersion": "rapidocr",
+            "metadata": {"width": width, "height": height},
+            "readResult": {"blocks": [{"lines": [
+                {
+                    "text": text,
+                    "boundingPolygon": [{"x": float(x), "y": float(y)} for x, y in box]
+                }
+                for box, text, score in lines if float(score) >= self.min_score
+            ]}]}
+        }
+
+    def recognize(self, image: ImageInput) -> Dict:
+        return self.recognize_batch([image])[0]
+
+    def recognize_batch(self, images: List[ImageInput]) -> List[Dict]:
+        arrays = [self.to_bgr(image) for image in images]
+        with metrics.stage("local_ocr", images=len(arrays)):
+            results = list(self.executor.map(run_local_ocr, arrays))
+        return [self.to_response(lines, image) for lines, image in zip(results, arrays)]
+
+class FallbackOCR(OCRBackend):
+    """
+    Azure first; while it answers 429 the local engine is used instead of retrying.
+    """
+    def __init__(self, primary: AzureOCRClient, fallback: OCRBackend):
+        self.primary = primary
+        self.fallback = fallback
+        self.name = f"{primary.name}+{fallback.name}"
+
+    def recognize(self, image: ImageInput) -> Dict:
+        try:
+            return self.primary.recognize(image, retries=0)
+        except Exception as e:
+            if not is_rate_limited(e):
+                raise
+            metrics.OCR_FALLBACKS.labels(self.primary.name, self.fallback.name).inc()
+            return self.fallback.recognize(image)
+
+_client: Optional[AzureOCRClient] = None
+_client_lock = threading.Lock()
+_backend: Optional[OCRBackend] = None
+_backend_lock = threading.Lock()
+
+def get_ocr_client() -> AzureOCRClient:
+    """
+    The process-wide OCR client, built on first use.
+    """
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = AzureOCRClient(
+                    endpoint=os.getenv("AZURE_ENDPOINT"),
+                    subscription_key=os.getenv("AZURE_SUBSCRIPTION_KEY"),
+                    connect_timeout=float(os.getenv("OCR_CONNECT_TIMEOUT", "5")),
+                    read_timeout=float(os.getenv("OCR_READ_TIMEOUT", "60")),
+                    max_retries=int(os.getenv("OCR_MAX_RETRIES", "5")),
+                    backoff_factor=float(os.getenv("OCR_BACKOFF_FACTOR", "0.5"))
+                )
+    return _client
+
+def build_ocr_backend() -> OCRBackend:
+    if OCR_BACKEND == "local":
+        return LocalOCREngine(OCR_LOCAL_WORKERS, OCR_LOCAL_POOL, OCR_LOCAL_MIN_SCORE)
+    if OCR_BACKEND != "azure":
+        raise ValueError(f"Unsupported OCR backend: {OCR_BACKEND}")
+    if OCR_FALLBACK == "local":
+        return FallbackOCR(get_ocr_client(), LocalOCREngine(OCR_LOCAL_WORKERS, OCR_LOCAL_POOL, OCR_LOCAL_MIN_SCORE))
+    return get_ocr_client()
+
+def get_ocr_backend() -> OCRBackend:
+    """
+    The OCR backend selected by OCR_BACKEND and OCR_FALLBACK, built on first use.
+    """
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                _backend = build_ocr_backend()
+    return _backend
+
+def uses_local_engine() -> bool:
+    return OCR_BACKEND == "local" or OCR_FALLBACK == "local"
+
+def warmup():
+    if uses_local_engine() and OCR_LOCAL_POOL == "thread":
+        models.warmup(["rapidocr"])
+
+def version() -> str:
+    """
+    Part of the cache key of OCR-derived results.
+    """
+    return OCR_BACKEND + (f"+{OCR_FALLBACK}" if OCR_FALLBACK else "")
+
+def encode_png(img: np.ndarray) -> bytes:
+    """
+    Encode an RGB image array as PNG bytes.
+    """
+    ok, buffer = cv2.imencode('.png', cv2.cvtColor(img, cv2.COLOR_RGB2BGR))
+    if not ok:
+        raise ValueError("Failed to encode image")
+    return buffer.tobytes()
+
+def process_image(image: Union[str, bytes, np.ndarray],
+                  scope: Union[Tuple[int, int, int, int], str] = "full") -> Optional[OCRResult]:
+    """
+    OCR an image given as a file path, encoded bytes or an RGB array.
+    Files and bytes are passed on as-is unless a crop scope is given; arrays are only
+    encoded if the backend needs it.
+    """
     try:
-        # Load and crop image if needed
-        img = Image.open(image_path)
-        
-        if scope != "full":
-            x_min, y_min, x_max, y_max = scope
-            img = img.crop((x_min, y_min, x_max, y_max))
-        
-        # Save cropped image temporarily
-        rgb_img = img.convert('RGB')
-        # temp_path = f"./cropped.jpg"
-        # img.save(temp_path)
-        
-        client = AzureOCRClient(
-            endpoint=os.getenv("AZURE_ENDPOINT"),
-            subscription_key=os.getenv("AZURE_SUBSCRIPTION_KEY")
-        )
-        
-        result = client.recognize_text(image_path)
-        print()
-        # os.remove(temp_path)
-        return json.dumps(result, indent=2, ensure_ascii=False)
-        
+        return OCRResult.from_response(get_ocr_backend().recognize(load_input(image, scope)))
     except Exception as e:
         print('Error:', str(e))
         return None
 
-def save_result_to_json(result: str, output_path: str = 'ocr_result.json'):
+def process_images(images: List[Union[str, bytes, np.ndarray]],
+                   scope: Union[Tuple[int, int, int, int], str] = "full") -> List[Optional[OCRResult]]:
+    """
+    OCR several images, each cropped to scope, in one batch; a failed batch gives None for each image.
+    """
+    try:
+        responses = get_ocr_backend().recognize_batch([load_input(image, scope) for image in images])
+        return [OCRResult.from_response(response) for response in responses]
+    except Exception as e:
+        print('Error:', str(e))
+        return [None] * len(images)
+
+def load_input(image: Union[str, bytes, np.ndarray], scope: Union[Tuple[int, int, int, int], str]) -> ImageInput:
+    if isinstance(image, np.ndarray):
+        if scope != "full":
+            x_min, y_min, x_max, y_max = scope
+            image = image[y_min:y_max, x_min:x_max]
+        return image
+    if scope != "full":
+        img = Image.open(image if isinstance(image, str) else io.BytesIO(image))
+        x_min, y_min, x_max, y_max = scope
+        return np.array(img.convert('RGB').crop((x_min, y_min, x_max, y_max)))
+    if isinstance(image, str):
+        with open(image, 'rb') as f:
+            return f.read()
+    return image
+
+def save_result_to_json(result: Optional[OCRResult], output_path: str = 'ocr_result.json'):
     if not result:
         return
         
     try:
-        parsed_json = json.loads(result)
-        formatted_json = json.dumps(parsed_json, indent=2, ensure_ascii=False)
+        formatted_json = json.dumps(result.to_dict(), indent=2, ensure_ascii=False)
         
         with open(output_path, 'w', encoding='utf-8') as f:
             f.write(formatted_json)
@@ -0,0 +1,304 @@
+import atexit
+import json
+import os
+import queue
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from typing import List, Optional
+
+# The UNO bridge ships with LibreOffice's own Python bindings (e.g. python3-uno).
+# They are built for the system Python, so when this interpreter can't import them the
+# UNO side runs in a helper process under OFFICE_PYTHON (this file with --bridge).
+# Without either, workers fall back to one-shot conversions that still reuse a warm profile.
+try:
+    import uno
+    from com.sun.star.beans import PropertyValue
+except ImportError:
+    uno = None
+
+SOFFICE_BINARY = os.getenv("SOFFICE_BINARY", "libreoffice")
+OFFICE_PYTHON = os.getenv("OFFICE_PYTHON", "/usr/bin/python3")
+
+_bridge_python: Optional[bool] = None
+_bridge_python_lock = threading.Lock()
+
+def bridge_available() -> bool:
+    """
+    Whether OFFICE_PYTHON can import uno; checked once.
+    """
+    global _bridge_python
+    if _bridge_python is None:
+        with _bridge_python_lock:
+            if _bridge_python is None:
+                try:
+                    _bridge_python = subprocess.run(
+                        [OFFICE_PYTHON, "-c", "import uno"],
+                        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=30
+                    ).returncode == 0
+                except (OSError, subprocess.TimeoutExpired):
+                    _bridge_python = False
+    return _bridge_python
+
+class ConversionError(Exception):
+    pass
+
+def _free_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def _property(name, value):
+    prop = PropertyValue()
+    prop.Name = name
+    prop.Value = value
+    return prop
+
+class OfficeWorker:
+    """
+    One soffice instance with its own user profile.
+
+    With UNO available, in this process or through a bridge process, the instance stays
+    up and listens on a local socket, so a conversion only pays for loading and exporting
+    the document. Otherwise each conversion runs `--convert-to` against this worker's
+    already initialised profile.
+    """
+    def __init__(self, index: int, startup_timeout: float = 30, profile_dir: Optional[str] = None):
+        self.index = index
+        self.startup_timeout = startup_timeout
+        self.profile_dir = profile_dir or tempfile.mkdtemp(prefix=f"soffice-{index}-")
+        self.process: Optional[subprocess.Popen] = None
+        self.desktop = None
+        self.bridge: Optional[subprocess.Popen] = None
+        self.jobs = 0
+
+    @property
+    def profile_url(self) -> str:
+        return "file://" + self.profile_dir
+
+    def start(self):
+        if uno is None:
+            self.start_bridge()
+            return
+        if self.desktop is not None:
+            return
+        port = _free_port()
+        self.process = subprocess.Popen([
+            SOFFICE_BINARY, "--headless", "--invisible", "--nologo", "--nodefault",
+            "--norestore", "--nolockcheck",
+            f"-env:UserInstallation={self.profile_url}",
+            f"--accept=socket,host=127.0.0.1,port={port};urp;StarOffice.ComponentContext"
+        ], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+        local_ctx = uno.getComponentContext()
+        resolver = local_ctx.ServiceManager.createInstanceWithContext("com.sun.star.bridge.UnoUrlResolver", local_ctx)
+        deadline = time.time() + self.startup_timeout
+        while True:
+            try:
+                ctx = resolver.resolve(f"uno:socket,host=127.0.0.1,port={port};urp;StarOffice.ComponentContext")
+                break
+            except Exception:
+                if time.time() > deadline or self.process.poll() is not None:
+                    self.stop()
+                    raise ConversionError("LibreOffice worker failed to start")
+                time.sleep(0.25)
+        self.desktop = ctx.ServiceManager.createInstanceWithContext("com.sun.star.frame.Desktop", ctx)
+
+    def start_bridge(self):
+        if self.bridge is not None or not bridge_available():
+            return
+        self.bridge = subprocess.Popen(
+            [OFFICE_PYTHON, os.path.abspath(__file__), "--bridge", self.profile_dir, str(self.startup_timeout)],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True, bufsize=1
+        )
+        reply = self.read_bridge(self.startup_timeout + 5)
+        if "error" in reply:
+            raise ConversionError(reply["error"])
+
+    def read_bridge(self, timeout: float) -> dict:
+        # Killing the bridge ends a read that would otherwise block forever
+        timer = threading.Timer(timeout, self.bridge.kill)
+        timer.start()
+        try:
+            line = self.bridge.stdout.readline()
+        finally:
+            timer.cancel()
+        if not line:
+            self.bridge.wait()
+            self.bridge = None
+            return {"error": f"LibreOffice bridge stopped after {timeout}s or on failure"}
+        return json.loads(line)
+
+    def convert(self, docx_path: str, out_dir: str, timeout: float) -> str:
+        """
+        Convert docx_path to a PDF inside out_dir and return the PDF path.
+        """
+        self.jobs += 1
+        pdf_path = os.path.join(out_dir, os.path.splitext(os.path.basename(docx_path))[0] + ".pdf")
+
+        if uno is None and bridge_available():
+            self.start_bridge()
+            self.bridge.stdin.write(json.dumps({"docx": docx_path, "out_dir": out_dir, "timeout": timeout}) + "\n")
+            self.bridge.stdin.flush()
+            # The bridge enforces the timeout itself; this only guards against a wedged bridge
+            reply = self.read_bridge(timeout + 10)
+            if "error" in reply:
+                raise ConversionError(reply["error"])
+            pdf_path = reply["pdf"]
+        elif uno is None:
+            try:
+                subprocess.run([
+                    SOFFICE_BINARY, "--headless", "--norestore", "--nolockcheck",
+                    f"-env:UserInstallation={self.profile_url}",
+                    "--convert-to", "pdf", "--outdir", out_dir, docx_path
+                ], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=timeout, check=True)
+            except subprocess.TimeoutExpired:
+                raise ConversionError(f"Conversion timed out after {timeout}s")
+            except subprocess.CalledProcessError as e:
+                raise ConversionError(f"LibreOffice exited with status {e.returncode}")
+        else:
+            self.start()
+            # A hung conversion blocks inside UNO; killing soffice unblocks it with an error
+            timer = threading.Timer(timeout, self.kill)
+            timer.start()
+            try:
+                doc = self.desktop.loadComponentFromURL(
+                    uno.systemPathToFileUrl(os.path.abspath(docx_path)), "_blank", 0,
+                    (_property("Hidden", True),)
+                )
+                try:
+                    doc.storeToURL(
+                        uno.systemPathToFileUrl(os.path.abspath(pdf_path)),
+                        (_property("FilterName", "writer_pdf_Export"),)
+                    )
+                finally:
+                    doc.close(True)
+            except Exception as e:
+                if not timer.is_alive():
+                    raise ConversionError(f"Conversion timed out after {timeout}s")
+                raise ConversionError(f"Conversion failed: {str(e)}")
+            finally:
+                timer.cancel()
+
+        if not os.path.exists(pdf_path):
+            raise ConversionError("LibreOffice produced no PDF")
+        return pdf_path
+
+    def kill(self):
+        if self.process is not None and self.process.poll() is None:
+            self.process.kill()
+
+    def stop(self):
+        if self.bridge is not None:
+            # Closing stdin ends the bridge, which stops its soffice
+            try:
+                self.bridge.stdin.close()
+                self.bridge.wait(timeout=10)
+            except (OSError, subprocess.TimeoutExpired):
+                self.bridge.kill()
+                self.bridge.wait()
+            self.bridge = None
+        if self.desktop is not None:
+            try:
+                self.desktop.terminate()
+            except Exception:
+                pass
+            self.desktop = None
+        if self.process is not None:
+            try:
+                self.process.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+            self.process = None
+        shutil.rmtree(self.profile_dir, ignore_errors=True)
+
+class OfficePool:
+    """
+    A fixed number of LibreOffice workers shared by all conversions.
+
+    Workers start lazily, are recycled after max_jobs conversions or any failure,
+    and every conversion runs in its own temporary directory.
+    """
+    def __init__(self, size: int = 2, max_jobs: int = 50, timeout: float = 60):
+        self.size = max(1, size)
+        self.max_jobs = max_jobs
+        self.timeout = timeout
+        self._created = 0
+        self._idle: "queue.Queue[OfficeWorker]" = queue.Queue()
+        self._workers: List[OfficeWorker] = []
+        self._lock = threading.Lock()
+        for _ in range(self.size):
+            self._idle.put(self._new_worker())
+        atexit.register(self.close)
+
+    def _new_worker(self) -> OfficeWorker:
+        with self._lock:
+            worker = OfficeWorker(self._created)
+            self._created += 1
+            self._workers.append(worker)
+            return worker
+
+    def _retire(self, worker: OfficeWorker):
+        worker.stop()
+        with self._lock:
+            self._workers.remove(worker)
+
+    def convert(self, content: bytes, filename: str = "document.docx") -> bytes:
+        """
+        Convert a document to PDF and return the PDF bytes.
+        """
+        work_dir = tempfile.mkdtemp(prefix="convert-")
+        worker = self._idle.get()
+        healthy = False
+        try:
+            docx_path = os.path.join(work_dir, "input" + (os.path.splitext(filename)[1] or ".docx"))
+            with open(docx_path, "wb") as f:
+                f.write(content)
+            pdf_path = worker.convert(docx_path, work_dir, self.timeout)
+            with open(pdf_path, "rb") as f:
+                pdf = f.read()
+            healthy = True
+            return pdf
+        finally:
+            if not healthy or worker.jobs >= self.max_jobs:
+                self._retire(worker)
+                worker = self._new_worker()
+            self._idle.put(worker)
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    def close(self):
+        with self._lock:
+            workers = list(self._workers)
+        for worker in workers:
+            worker.stop()
+
+def serve_bridge(profile_dir: str, startup_timeout: float):
+    """
+    Run under a Python that has uno: keep one soffice up and convert the documents named
+    on stdin, one JSON request per line, answering each with a JSON line on stdout.
+    """
+    worker = OfficeWorker(0, startup_timeout, profile_dir)
+    try:
+        worker.start()
+    except ConversionError as e:
+        print(json.dumps({"error": str(e)}), flush=True)
+        return
+    print(json.dumps({"ready": True}), flush=True)
+    try:
+        for line in sys.stdin:
+            request = json.loads(line)
+            try:
+                reply = {"pdf": worker.convert(request["docx"], request["out_dir"], request["timeout"])}
+            except ConversionError as e:
+                reply = {"error": str(e)}
+            print(json.dumps(reply), flush=True)
+    finally:
+        worker.stop()
+
+if __name__ == '__main__' and len(sys.argv) == 4 and sys.argv[1] == "--bridge":
+    serve_bridge(sys.argv[2], float(sys.argv[3]))
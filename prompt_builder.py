@@ -0,0 +1,74 @@
+import os
+import re
+from typing import Dict, List
+
+from models import get_tokenizer
+from templates import get_templates
+
+SYSTEM_PROMPT = "You are a package proofreading system"
+
+# Bump when the message layout or the text normalization changes, so cached results are recomputed
+PROMPT_LAYOUT_VERSION = "2"
+
+# Repeated lines at least this long are dropped; shorter ones ("0公克") can legitimately repeat
+PROMPT_DEDUPE_MIN_CHARS = int(os.getenv("PROMPT_DEDUPE_MIN_CHARS", "8"))
+
+ZERO_WIDTH = dict.fromkeys(map(ord, "\u200b\u200c\u200d\u2060\ufeff"))
+SPACES = re.compile(r"[ \u3000\xa0\r\f\v]+")
+CELL_SEPARATOR = re.compile(r" ?\t ?")
+# Lines without a letter, digit or CJK character; "*" is kept since the prompts give it a meaning
+NOISE_LINE = re.compile(r"^[^\w*]*$")
+
+# Chat formats add a few tokens per message around the content
+MESSAGE_OVERHEAD_TOKENS = 4
+REPLY_OVERHEAD_TOKENS = 3
+
+def normalize_text(text: str, dedupe_min_chars: int = PROMPT_DEDUPE_MIN_CHARS) -> str:
+    """
+    Tidy OCR or document text before it is sent to the LLM: collapse runs of spaces, drop
+    zero-width characters, punctuation-only noise lines and repeated lines, and keep at
+    most one blank line between blocks. Tabs between table cells are kept.
+    """
+    lines = []
+    seen = set()
+    blank = False
+    for raw in text.translate(ZERO_WIDTH).split("\n"):
+        line = CELL_SEPARATOR.sub("\t", SPACES.sub(" ", raw)).strip()
+        if not line:
+            blank = bool(lines)
+            continue
+        if NOISE_LINE.match(line):
+            continue
+        if len(line) >= dedupe_min_chars:
+            if line in seen:
+                continue
+            seen.add(line)
+        if blank:
+            lines.append("")
+            blank = False
+        lines.append(line)
+    return "\n".join(lines)
+
+def build_prompt(template_name: str, text: str) -> List[Dict[str, str]]:
+    """
+    Messages for a templated LLM call. The system message holds only static text, the
+    instructions and output template, so it is identical across calls and providers can
+    serve it from their prompt cache; the normalized document text follows as the user message.
+    """
+    template = get_templates().prompt(template_name).strip()
+    return [
+        {"role": "system", "content": f"{SYSTEM_PROMPT}\n\n{template}"},
+        {"role": "user", "content": normalize_text(text)},
+    ]
+
+def count_tokens(text: str) -> int:
+    return get_tokenizer().count(text)
+
+def count_message_tokens(messages: List[Dict[str, str]]) -> int:
+    return sum(count_tokens(m["content"]) + MESSAGE_OVERHEAD_TOKENS for m in messages) + REPLY_OVERHEAD_TOKENS
+
+def version() -> str:
+    """
+    Part of the cache key of LLM outputs built from these prompts.
+    """
+    return f"prompt{PROMPT_LAYOUT_VERSION}-{PROMPT_DEDUPE_MIN_CHARS}"
@@ -0,0 +1,228 @@
+import contextvars
+import os
+import random
+import re
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Optional
+
+INTERACTIVE = "interactive"
+BATCH = "batch"
+
+# Lane of the work running in the current context; batch calls yield to interactive ones
+_priority: contextvars.ContextVar = contextvars.ContextVar("scheduler_priority", default=INTERACTIVE)
+
+@contextmanager
+def priority(lane: str):
+    token = _priority.set(lane)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+class RateLimitedError(Exception):
+    """
+    A provider answered 429. retry_after is the delay it asked for, if any.
+    """
+    def __init__(self, message: str = "Rate limited", retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+def is_rate_limited(error: Exception) -> bool:
+    if isinstance(error, RateLimitedError):
+        return True
+    if getattr(error, "status_code", None) == 429:
+        return True
+    response = getattr(error, "response", None)
+    return getattr(response, "status_code", None) == 429
+
+def retry_after_of(error: Exception) -> Optional[float]:
+    if isinstance(error, RateLimitedError):
+        return error.retry_after
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+class TokenBucket:
+    """
+    Refills `rate_per_minute` tokens per minute up to one minute's worth.
+    reserve() always takes the tokens and returns how long the caller must wait for them.
+    """
+    def __init__(self, rate_per_minute: float):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = rate_per_minute
+        self.tokens = rate_per_minute
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, amount: float) -> float:
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # Never ask for more than a full bucket, or the request could never run
+            self.tokens -= min(amount, self.capacity)
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+class AIMDLimiter:
+    """
+    Concurrency limit that grows by about one per window of successful calls and
+    is multiplied by `decrease` on a 429 or a call slower than the latency target.
+    Waiting interactive calls are always admitted before waiting batch calls.
+    """
+    def __init__(self, initial: float, maximum: float, minimum: float = 1, decrease: float = 0.5,
+                 latency_target: Optional[float] = None, cooldown: float = 1.0):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.decrease = decrease
+        self.latency_target = latency_target
+        self.cooldown = cooldown
+        self.in_flight = 0
+        self.waiting = {INTERACTIVE: 0, BATCH: 0}
+        self._last_decrease = 0.0
+        self._condition = threading.Condition()
+
+    def _can_start(self, lane: str) -> bool:
+        if self.in_flight >= int(self.limit):
+            return False
+        return lane == INTERACTIVE or self.waiting[INTERACTIVE] == 0
+
+    def acquire(self, lane: str):
+        with self._condition:
+            self.waiting[lane] += 1
+            try:
+                while not self._can_start(lane):
+                    self._condition.wait()
+            finally:
+                self.waiting[lane] -= 1
+            self.in_flight += 1
+
+    def release(self, throttled: bool = False, latency: Optional[float] = None):
+        with self._condition:
+            self.in_flight -= 1
+            slow = self.latency_target and latency is not None and latency > self.latency_target
+            if throttled or slow:
+                # One burst of 429s should only halve the limit once
+                now = time.monotonic()
+                if now - self._last_decrease > self.cooldown:
+                    self.limit = max(self.minimum, self.limit * self.decrease)
+                    self._last_decrease = now
+            elif latency is not None:
+                self.limit = min(self.maximum, self.limit + 1.0 / self.limit)
+            self._condition.notify_all()
+
+class ProviderScheduler:
+    """
+    Admission control for one external provider: RPM/TPM token buckets, an AIMD
+    concurrency limit with priority lanes, and retries with backoff on 429s.
+    """
+    def __init__(self, name: str, rpm: float = 0, tpm: float = 0, initial_concurrency: int = 4,
+                 max_concurrency: int = 16, latency_target: Optional[float] = None, max_retries: int = 3,
+                 backoff: float = 1.0):
+        self.name = name
+        self.requests = TokenBucket(rpm) if rpm else None
+        self.tokens = TokenBucket(tpm) if tpm else None
+        self.limiter = AIMDLimiter(initial_concurrency, max_concurrency, latency_target=latency_target)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.counters = {"calls": 0, "succeeded": 0, "failed": 0, "throttled": 0, "retried": 0}
+        self.latency_total = 0.0
+        self.wait_total = 0.0
+        self._lock = threading.Lock()
+
+    def _count(self, key: str, amount: float = 1):
+        with self._lock:
+            self.counters[key] += amount
+
+    def call(self, fn: Callable[[], Any], tokens: float = 1, lane: Optional[str] = None,
+             retries: Optional[int] = None) -> Any:
+        """
+        Run fn within the rate limits; 429s are retried up to `retries` times (max_retries by default).
+        """
+        lane = lane or _priority.get()
+        retries = self.max_retries if retries is None else retries
+        for attempt in range(retries + 1):
+            queued_at = time.monotonic()
+            delay = max(
+                self.requests.reserve(1) if self.requests else 0.0,
+                self.tokens.reserve(tokens) if self.tokens else 0.0
+            )
+            if delay:
+                time.sleep(delay)
+            self.limiter.acquire(lane)
+            started = time.monotonic()
+            with self._lock:
+                self.counters["calls"] += 1
+                self.wait_total += started - queued_at
+
+            try:
+                result = fn()
+            except Exception as e:
+                throttled = is_rate_limited(e)
+                self.limiter.release(throttled=throttled)
+                if not throttled:
+                    self._count("failed")
+                    raise
+                self._count("throttled")
+                if attempt == retries:
+                    self._count("failed")
+                    raise
+                self._count("retried")
+                retry_after = retry_after_of(e)
+                time.sleep(retry_after if retry_after is not None else self.backoff * (2 ** attempt) * (1 + random.random()))
+                continue
+
+            latency = time.monotonic() - started
+            self.limiter.release(latency=latency)
+            with self._lock:
+                self.counters["succeeded"] += 1
+                self.latency_total += latency
+            return result
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            calls = self.counters["calls"]
+            return {
+                **self.counters,
+                "in_flight": self.limiter.in_flight,
+                "concurrency_limit": int(self.limiter.limit),
+                "waiting": dict(self.limiter.waiting),
+                "avg_latency": self.latency_total / self.counters["succeeded"] if self.counters["succeeded"] else 0.0,
+                "avg_wait": self.wait_total / calls if calls else 0.0
+            }
+
+_schedulers: Dict[str, ProviderScheduler] = {}
+_schedulers_lock = threading.Lock()
+
+def get_scheduler(name: str) -> ProviderScheduler:
+    """
+    The process-wide scheduler for a provider, configured from SCHED_<NAME>_* settings.
+    """
+    if name not in _schedulers:
+        with _schedulers_lock:
+            if name not in _schedulers:
+                prefix = "SCHED_" + re.sub(r'[^A-Z0-9]+', '_', name.upper()) + "_"
+
+                def setting(key: str, default: str) -> str:
+                    return os.getenv(prefix + key) or os.getenv("SCHED_" + key, default)
+
+                latency_target = float(setting("LATENCY_TARGET", "0"))
+                _schedulers[name] = ProviderScheduler(
+                    name,
+                    rpm=float(setting("RPM", "0")),
+                    tpm=float(setting("TPM", "0")),
+                    initial_concurrency=int(setting("CONCURRENCY", "4")),
+                    max_concurrency=int(setting("MAX_CONCURRENCY", "16")),
+                    latency_target=latency_target or None,
+                    max_retries=int(setting("MAX_RETRIES", "3"))
+                )
+    return _schedulers[name]
+
+def scheduler_stats() -> Dict[str, Dict[str, Any]]:
+    with _schedulers_lock:
+        schedulers = dict(_schedulers)
+    return {name: scheduler.stats() for name, scheduler in schedulers.items()}
@@ -2,40 +2,30 @@ from PIL import Image
 import numpy as np
 import cv2
 import os
-from rapid_table_det.inference import TableDetector
 from rapid_table_det.utils.visuallize import visuallize, extract_table_img
+from models import get_table_detector
+import metrics
 
-# Initialize the table detector once as a global variable
-TABLE_DETECTOR = TableDetector()
-
-def process_table(image_path):
+def detect_table(img):
     """
-    Process an image to detect and extract tables.
-    
+    Detect the first table in an in-memory image.
+
     Args:
-        image_path (str): Path to the input image file
-        
+        img (np.ndarray): RGB image array
+
     Returns:
-        tuple: (table_image_path, no_table_image_path) if table is found,
+        tuple: (table_img, no_table_img) RGB arrays if a table is found,
                None if no table is detected
     """
-    # Check if input image exists
-    if not os.path.exists(image_path):
-        print(f"Image file not found: {image_path}")
-        return None
-    
-    # Detect tables using the global detector instance
-    result, elapse = TABLE_DETECTOR(image_path)
-    
+    # The detector treats arrays as BGR, like OpenCV
+    with metrics.stage("table_detection", width=img.shape[1], height=img.shape[0]):
+        result, elapse = get_table_detector()(cv2.cvtColor(img, cv2.COLOR_RGB2BGR))
+
     # If no table is detected, return None
     if len(result) == 0:
         print("No table detected.")
         return None
 
-    # Load the image with PIL and convert to a numpy array (RGB)
-    pil_img = Image.open(image_path).convert("RGB")
-    img = np.array(pil_img)
-    
     # Create a copy for later processing (to remove the table region)
     img_without_table = img.copy()
     
@@ -69,6 +59,32 @@ def process_table(image_path):
     # Fill the table region with white in the "no table" image
     img_without_table[mask == 255] = [255, 255, 255]
 
+    return table_img_np, img_without_table
+
+def process_table(image_path):
+    """
+    Process an image to detect and extract tables.
+    
+    Args:
+        image_path (str): Path to the input image file
+        
+    Returns:
+        tuple: (table_image_path, no_table_image_path) if table is found,
+               None if no table is detected
+    """
+    # Check if input image exists
+    if not os.path.exists(image_path):
+        print(f"Image file not found: {image_path}")
+        return None
+
+    # Load the image with PIL and convert to a numpy array (RGB)
+    img = np.array(Image.open(image_path).convert("RGB"))
+
+    result = detect_table(img)
+    if result is None:
+        return None
+    table_img_np, img_without_table = result
+
     # Convert numpy arrays to PIL Images
     table_image = Image.fromarray(table_img_np)
     image_without_table = Image.fromarray(img_without_table)
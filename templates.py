@@ -0,0 +1,143 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from typing import Any, Dict, Optional, Tuple
+
+# Prompt templates in PROMPTS_FOLDER_PATH
+DOCX_PROMPT = 'docx2json_prompt_template.txt'
+PROOFREADING_PROMPT = 'proofreading_prompt_template.txt'
+NUTRITION_PROMPT = 'proofreading_prompt_template(nutrition).txt'
+
+# Output templates in JSONS_FOLDER_PATH
+DOCX_SCHEMA = 'docx2json_template.json'
+PROOFREADING_SCHEMA = 'proofreading_template.json'
+
+class Schema:
+    """
+    A JSON template compiled into a tree of required keys.
+    A value is valid when every key of the template is present, recursively for nested objects.
+    """
+    def __init__(self, template: Dict):
+        self.template = template
+        self._required = self._compile(template)
+
+    @classmethod
+    def _compile(cls, template: Dict) -> Tuple[Tuple[str, Optional[tuple]], ...]:
+        return tuple(
+            (key, cls._compile(value) if isinstance(value, dict) else None)
+            for key, value in template.items()
+        )
+
+    def validate(self, data: Any) -> bool:
+        def check(value: Any, required: tuple) -> bool:
+            if not isinstance(value, dict):
+                return False
+            for key, children in required:
+                if key not in value:
+                    return False
+                if children is not None and not check(value[key], children):
+                    return False
+            return True
+
+        return check(data, self._required)
+
+class TemplateFile:
+    def __init__(self, path: str, mtime: float, content: bytes):
+        self.path = path
+        self.mtime = mtime
+        self.digest = hashlib.sha256(content).hexdigest()
+        self.text = content.decode('utf-8')
+        self.schema = Schema(json.loads(self.text)) if path.endswith('.json') else None
+
+class TemplateRegistry:
+    """
+    Prompt templates and JSON schemas, read once and kept in memory.
+
+    Files are re-stat'ed at most every `check_interval` seconds and reloaded when their
+    mtime changes, so edited prompts take effect without a restart.
+    """
+    def __init__(self, prompts_dir: str, schemas_dir: str, check_interval: float = 2.0):
+        self.prompts_dir = prompts_dir
+        self.schemas_dir = schemas_dir
+        self.check_interval = check_interval
+        self._files: Dict[str, TemplateFile] = {}
+        self._last_check = 0.0
+        self._lock = threading.Lock()
+
+    def _path(self, name: str) -> str:
+        directory = self.schemas_dir if name.endswith('.json') else self.prompts_dir
+        return os.path.join(directory, name)
+
+    def _load(self, path: str) -> TemplateFile:
+        mtime = os.path.getmtime(path)
+        with open(path, 'rb') as f:
+            return TemplateFile(path, mtime, f.read())
+
+    def load_all(self):
+        for name in (DOCX_PROMPT, PROOFREADING_PROMPT, NUTRITION_PROMPT, DOCX_SCHEMA, PROOFREADING_SCHEMA):
+            self._get(name)
+
+    def _refresh(self):
+        now = time.monotonic()
+        if now - self._last_check < self.check_interval:
+            return
+        with self._lock:
+            if now - self._last_check < self.check_interval:
+                return
+            self._last_check = now
+            for name, template in list(self._files.items()):
+                try:
+                    if os.path.getmtime(template.path) == template.mtime:
+                        continue
+                    self._files[name] = self._load(template.path)
+                    print(f"Reloaded template {name}")
+                except (OSError, ValueError) as e:
+                    # Keep serving the last good version while a file is being rewritten
+                    print(f"Failed to reload template {name}: {str(e)}")
+
+    def _get(self, name: str) -> TemplateFile:
+        self._refresh()
+        template = self._files.get(name)
+        if template is None:
+            with self._lock:
+                template = self._files.get(name)
+                if template is None:
+                    template = self._files[name] = self._load(self._path(name))
+        return template
+
+    def prompt(self, name: str) -> str:
+        return self._get(name).text
+
+    def schema(self, name: str) -> Schema:
+        return self._get(name).schema
+
+    def version(self, *names: str) -> str:
+        """
+        Digest of the current contents of the given templates, for cache keys.
+        """
+        digest = hashlib.sha256()
+        for name in names:
+            digest.update(self._get(name).digest.encode('ascii'))
+        return digest.hexdigest()
+
+_registry: Optional[TemplateRegistry] = None
+_registry_lock = threading.Lock()
+
+def get_templates() -> TemplateRegistry:
+    """
+    The process-wide registry for PROMPTS_FOLDER_PATH and JSONS_FOLDER_PATH, loaded on first use.
+    """
+    global _registry
+    if _registry is None:
+        with _registry_lock:
+            if _registry is None:
+                registry = TemplateRegistry(
+                    os.getenv("PROMPTS_FOLDER_PATH"),
+                    os.getenv("JSONS_FOLDER_PATH"),
+                    check_interval=float(os.getenv("TEMPLATE_RELOAD_INTERVAL", "2"))
+                )
+                registry.load_all()
+                _registry = registry
+    return _registry
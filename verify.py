@@ -1,42 +1,67 @@
-import re
 import json
 import os
-import docx2txt
+import zipfile
+import xml.etree.ElementTree as ET
 import PyPDF2
-from ocr import process_image
-from llm import llm
-from typing import Dict, Any, List, Tuple, Optional, Union
-from collections import defaultdict
-from table import process_table
+from ocr import process_image, process_images, OCRResult, OCRLine
+import ocr
+from llm import llm_json
+import llm
+from jsonstream import parse_llm_json
+import prompt_builder
+import extract
+import metrics
+from typing import Dict, Any, List, Tuple, Optional, Union, Callable
+from table import process_table, detect_table
+from templates import get_templates, DOCX_PROMPT, DOCX_SCHEMA, PROOFREADING_PROMPT, NUTRITION_PROMPT, PROOFREADING_SCHEMA
 from concurrent.futures import ThreadPoolExecutor, Future
 from threading import Lock
 import traceback
+import contextvars
 import time
 
-def merged(data):
-    if isinstance(data, str):
-        data = json.loads(data)
-    y_text_mapping = defaultdict(list)
+# Lines whose centres are within this fraction of the text height are on the same row
+MERGE_ROW_TOLERANCE = float(os.getenv("MERGE_ROW_TOLERANCE", "0.5"))
 
-    def get_average_y(boundingPolygon):
-        return sum(point["y"] for point in boundingPolygon) / len(boundingPolygon)
+def group_rows(lines: List[OCRLine], tolerance: float = MERGE_ROW_TOLERANCE,
+               min_margin: float = 5) -> List[List[str]]:
+    """
+    Cluster OCR lines into rows of text ordered left to right.
+    Lines are swept top to bottom; a line joins the current row when its centre is within
+    tolerance x text height (and at least min_margin pixels) of the row's mean centre.
+    """
+    boxes = []
+    for line in lines:
+        xs = [x for x, _ in line.polygon]
+        ys = [y for _, y in line.polygon]
+        boxes.append((sum(ys) / len(ys), max(ys) - min(ys), min(xs), line.text))
+    boxes.sort(key=lambda box: box[0])
 
-    error_margin = 5
+    rows = []
+    current = []
+    sum_y = sum_height = 0.0
+    for box in boxes:
+        if current:
+            mean_y = sum_y / len(current)
+            mean_height = sum_height / len(current)
+            if abs(box[0] - mean_y) <= max(tolerance * max(mean_height, box[1]), min_margin):
+                current.append(box)
+                sum_y += box[0]
+                sum_height += box[1]
+                continue
+            rows.append(current)
+        current = [box]
+        sum_y, sum_height = box[0], box[1]
+    if current:
+        rows.append(current)
 
-    def find_nearest_y(target_y, existing_ys, margin):
-        for y in existing_ys:
-            if abs(target_y - y) <= margin:
-                return y
-        return target_y
+    return [[box[3] for box in sorted(row, key=lambda box: box[2])] for row in rows]
 
-    for block in data["readResult"]["blocks"]:
-        for line in block["lines"]:
-            avg_y = get_average_y(line["boundingPolygon"])
-            nearest_y = find_nearest_y(round(avg_y), y_text_mapping.keys(), error_margin)
-            y_text_mapping[nearest_y].append(line["text"])
+def merged(data: Union[OCRResult, Dict, str]) -> str:
+    if not isinstance(data, OCRResult):
+        data = OCRResult.from_response(json.loads(data) if isinstance(data, str) else data)
 
-    y_sorted = sorted(y_text_mapping.keys())
-    merged_lines = [" ".join(y_text_mapping[y]) for y in y_sorted]
+    merged_lines = [" ".join(row) for row in group_rows(data.lines)]
     
     # Join the merged lines into a single string with newline characters between lines
     full_text = "\n".join(merged_lines)
@@ -60,32 +85,96 @@ def merged(data):
     
     return full_text
 
-def docx_to_json(docx_path: str) -> Dict:
-    print("starting docx_to_json")
-    print(docx_path)
+def docx_to_json_version() -> str:
+    """
+    Version of the docx_to_json output: changes with its prompt, prompt layout, extraction rules, schema or models.
+    """
+    return (get_templates().version(DOCX_PROMPT, DOCX_SCHEMA) + ":docx:" + prompt_builder.version() + ":"
+            + extract.version() + ":" + llm.version())
+
+def image_to_json_version() -> str:
+    """
+    Version of the image_to_json output: changes with its prompts, prompt layout, extraction rules, schema,
+    OCR backend, row merging or models.
+    """
+    return (get_templates().version(PROOFREADING_PROMPT, NUTRITION_PROMPT, PROOFREADING_SCHEMA)
+            + f":{ocr.version()}:rows{MERGE_ROW_TOLERANCE}:" + prompt_builder.version() + ":" + extract.version() + ":"
+            + llm.version())
+
+W_NS = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}'
+
+def extract_docx_text(docx_path: str) -> str:
+    """
+    Extract the body text of a DOCX file in document order.
+    Paragraphs become lines; table rows become lines with tab-separated cells.
+    Content controls and custom XML wrappers are read through.
+    """
+    with zipfile.ZipFile(docx_path) as docx:
+        root = ET.fromstring(docx.read('word/document.xml'))
+
+    def paragraph_text(paragraph) -> str:
+        parts = []
+        for node in paragraph.iter():
+            if node.tag == W_NS + 't':
+                parts.append(node.text or '')
+            elif node.tag == W_NS + 'tab':
+                parts.append('\t')
+            elif node.tag in (W_NS + 'br', W_NS + 'cr'):
+                parts.append('\n')
+        return ''.join(parts)
+
+    def children(element):
+        # w:sdt keeps its content in w:sdtContent; w:customXml wraps it directly
+        for child in element:
+            if child.tag == W_NS + 'sdt':
+                content = child.find(W_NS + 'sdtContent')
+                if content is not None:
+                    yield from children(content)
+            elif child.tag == W_NS + 'customXml':
+                yield from children(child)
+            else:
+                yield child
+
+    def cell_text(cell) -> str:
+        # Nested tables are flattened into the cell text
+        return ' '.join(text for text in (paragraph_text(p) for p in cell.iter(W_NS + 'p')) if text)
+
+    lines = []
+    for element in children(root.find(W_NS + 'body')):
+        if element.tag == W_NS + 'p':
+            lines.append(paragraph_text(element))
+        elif element.tag == W_NS + 'tbl':
+            for row in element.iter(W_NS + 'tr'):
+                cells = [cell_text(cell) for cell in children(row) if cell.tag == W_NS + 'tc']
+                lines.append('\t'.join(cells))
+    return '\n'.join(lines)
+
+def extract_pdf_text(pdf_path: str) -> str:
     all_text = ""
-    if not os.path.exists(docx_path):
-        raise ValueError(f"DOCX file not found: {docx_path}")
-    with open(docx_path, 'rb') as file:
+    with open(pdf_path, 'rb') as file:
         reader = PyPDF2.PdfReader(file)
         # Loop through all pages in the PDF
         for page_number, page in enumerate(reader.pages, start=1):
             text = page.extract_text()
             # Append the current page text to the variable
             all_text += text
-    prompt_path = os.path.join(os.getenv("PROMPTS_FOLDER_PATH"), 'docx2json_prompt_template.txt')
-    template_path = os.path.join(os.getenv("JSONS_FOLDER_PATH"), 'docx2json_template.json')
-    
-    with open(prompt_path, 'r', encoding='utf-8') as f:
-        prompt_template = f.read()
-    
-    json_str = clean_json_string(llm(prompt_template + all_text))
-    json_str = update_title_vailed(json_str)
-    # Replace single quotes with double quotes in the string before parsing
-    json_str = json_str.replace("'", '"')
-    result = json.loads(json_str)
+    return all_text
+
+def docx_to_json(docx_path: str) -> Dict:
+    """
+    Extract the specification fields from a DOCX file (read directly) or a PDF rendering of it.
+    """
+    print("starting docx_to_json")
+    print(docx_path)
+    if not os.path.exists(docx_path):
+        raise ValueError(f"DOCX file not found: {docx_path}")
+    if docx_path.lower().endswith('.pdf'):
+        all_text = extract_pdf_text(docx_path)
+    else:
+        all_text = extract_docx_text(docx_path)
+    result = extract_then_llm(DOCX_PROMPT, all_text)
     
-    if not validate_json_format(result, template_path):
+    if not validate_json_format(result, DOCX_SCHEMA):
         raise ValueError("DOCX JSON format invalid")
 
     def check_content(data: Dict[str, Any]) -> List[Tuple[str, str]]:
@@ -113,80 +202,132 @@ def docx_to_json(docx_path: str) -> Dict:
     print('done')
     return result
 
-def remove_json_comments(json_str: str) -> str:
-    """
-    Remove single-line and multi-line comments from a JSON-like string.
-    """
-    json_str = re.sub(r'//.*?\n', '', json_str)  # Remove single-line comments
-    json_str = re.sub(r'/\*.*?\*/', '', json_str, flags=re.DOTALL)  # Remove multi-line comments
-    return json_str
-
-def process_llm_task(prompt_path: str, ocr_result: str, lock: Lock) -> Dict:
+def process_llm_task(prompt_name: str, ocr_result: str) -> Dict:
     """
-    Process a single LLM task with thread safety.
+    Run the LLM on OCR text with the named prompt template.
     """
     try:
-        with lock:  # Ensure thread safety when reading the file
-            with open(prompt_path, 'r', encoding='utf-8') as f:
-                prompt_template = f.read()
-        llm_return = llm(prompt_template + str(ocr_result))
-        json_str = clean_json_string(llm_return)
-        json_str = update_title_vailed(json_str)
-        json_str = json_str.replace("'", '"')  # Convert single quotes to double quotes for valid JSON
-        json_str = remove_json_comments(json_str)  # Remove any annotations
-        return json.loads(json_str)  # Parse cleaned JSON
+        messages = prompt_builder.build_prompt(prompt_name, ocr_result)
+        return update_title_vailed(parse_llm_json(llm_json(messages)))
     except Exception as e:
         print(f"Error in LLM processing: {str(e)}")
         traceback.print_exc()
         raise
 
-def image_to_json(image_path: str, scope: Union[Tuple[int, int, int, int], str] = "full") -> Dict:
+def output_template(prompt_name: str) -> Dict:
+    """
+    The part of the output schema that the named prompt answers.
+    """
+    if prompt_name == DOCX_PROMPT:
+        return get_templates().schema(DOCX_SCHEMA).template
+    template = get_templates().schema(PROOFREADING_SCHEMA).template
+    if prompt_name == NUTRITION_PROMPT:
+        return {extract.NUTRITION: template[extract.NUTRITION]}
+    return {key: value for key, value in template.items() if key != extract.NUTRITION}
+
+def extract_then_llm(prompt_name: str, text: str, on_llm: Optional[Callable[[], None]] = None) -> Dict:
+    """
+    Fill the prompt's output from the text with the rule-based extractor, and run the LLM
+    only when some fields are left unresolved; those fields are taken from its answer.
+    """
+    if not extract.RULE_EXTRACTION:
+        if on_llm:
+            on_llm()
+        return process_llm_task(prompt_name, text)
+
+    template = output_template(prompt_name)
+    with metrics.stage("rule_extraction"):
+        result, unresolved = extract.extract(text, template)
+    metrics.RULE_EXTRACTIONS.labels(prompt_name, "complete" if not unresolved else "partial" if result else "none").inc()
+    if unresolved:
+        print(f"LLM fallback for {prompt_name}: {', '.join('.'.join(path) for path in unresolved)}")
+        if on_llm:
+            on_llm()
+        result = extract.fill_unresolved(result, process_llm_task(prompt_name, text), unresolved)
+    return extract.arrange(template, result)
+
+def ocr_then_llm(image_path: Union[str, Any], scope: Union[Tuple[int, int, int, int], str], prompt_name: str,
+                 on_llm: Callable[[], None]) -> Tuple[str, Dict]:
     """
-    Process image to JSON with parallel LLM processing
+    One branch of image_to_json: OCR an image, then extract its fields as soon as the text is ready.
+    """
+    return lines_then_llm(process_image(image_path, scope), prompt_name, on_llm)
+
+def lines_then_llm(ocr_lines: Optional[OCRResult], prompt_name: str, on_llm: Callable[[], None]) -> Tuple[str, Dict]:
+    if not ocr_lines:
+        raise ValueError("OCR processing failed")
+    ocr_result = merged(ocr_lines)
+    if not ocr_result:
+        raise ValueError("OCR processing failed")
+    return ocr_result, extract_then_llm(prompt_name, ocr_result, on_llm)
+
+def image_to_json(
+    image_path: Union[str, Any],
+    scope: Union[Tuple[int, int, int, int], str] = "full",
+    on_stage: Optional[Callable[[str], None]] = None
+) -> Dict:
+    """
+    Process image to JSON. The main label and the nutrition table are OCRed in parallel,
+    and each LLM call starts as soon as its own OCR result arrives.
+    image_path may also be an RGB numpy array, in which case nothing is written to disk.
+    on_stage, if given, is called with "ocr" and "llm" as processing moves on.
     """
     print("starting image_to_json")
-    if not os.path.exists(image_path):
-        raise ValueError(f"Image file not found: {image_path}")
+    # Process table
+    if isinstance(image_path, str):
+        if not os.path.exists(image_path):
+            raise ValueError(f"Image file not found: {image_path}")
+        table_result = process_table(image_path)
+    else:
+        table_result = detect_table(image_path)
 
-    # Process table and OCR
-    table_result = process_table(image_path)
     if table_result is None:
         return table_result
 
     nutrition_image_path, main_image_path = table_result
-    ocr_result = merged(process_image(main_image_path, scope))
-    nutrition_ocr_result = merged(process_image(nutrition_image_path, scope))
+    if on_stage:
+        on_stage("ocr")
 
-    if not ocr_result or not nutrition_ocr_result:
-        raise ValueError("OCR processing failed")
-    # Set up paths
-    prompt_path = os.path.join(os.getenv("PROMPTS_FOLDER_PATH"), 'proofreading_prompt_template.txt')
-    nutrition_prompt_path = os.path.join(os.getenv("PROMPTS_FOLDER_PATH"), 'proofreading_prompt_template(nutrition).txt')
-    template_path = os.path.join(os.getenv("JSONS_FOLDER_PATH"), 'proofreading_template.json')
+    llm_started = Lock()
 
-    # Create a lock for thread-safe file operations
-    file_lock = Lock()
+    def on_llm():
+        # Report the "llm" stage once, when the first branch reaches it
+        if on_stage and llm_started.acquire(blocking=False):
+            on_stage("llm")
 
-    # Process LLM tasks in parallel
+    # Run both OCR -> LLM branches in parallel, keeping the caller's scheduler lane
     with ThreadPoolExecutor(max_workers=2) as executor:
-        # Submit both tasks
-        main_future: Future = executor.submit(
-            process_llm_task, 
-            prompt_path, 
-            ocr_result, 
-            file_lock
-        )
-        nutrition_future: Future = executor.submit(
-            process_llm_task, 
-            nutrition_prompt_path, 
-            nutrition_ocr_result, 
-            file_lock
-        )
+        if ocr.get_ocr_backend().batched:
+            # Both crops go through the local engine's pool as one batch; the LLM branches follow
+            main_lines, nutrition_lines = process_images([main_image_path, nutrition_image_path], scope)
+            main_future: Future = executor.submit(
+                contextvars.copy_context().run, lines_then_llm, main_lines, PROOFREADING_PROMPT, on_llm
+            )
+            nutrition_future: Future = executor.submit(
+                contextvars.copy_context().run, lines_then_llm, nutrition_lines, NUTRITION_PROMPT, on_llm
+            )
+        else:
+            main_future = executor.submit(
+                contextvars.copy_context().run,
+                ocr_then_llm,
+                main_image_path,
+                scope,
+                PROOFREADING_PROMPT,
+                on_llm
+            )
+            nutrition_future = executor.submit(
+                contextvars.copy_context().run,
+                ocr_then_llm,
+                nutrition_image_path,
+                scope,
+                NUTRITION_PROMPT,
+                on_llm
+            )
 
         try:
             # Get results from both futures
-            main_result = main_future.result()
-            nutrition_result = nutrition_future.result()
+            _, main_result = main_future.result()
+            nutrition_ocr_result, nutrition_result = nutrition_future.result()
         except Exception as e:
             print(f"Error in parallel processing: {str(e)}")
             traceback.print_exc()
@@ -198,7 +339,7 @@ def image_to_json(image_path: str, scope: Union[Tuple[int, int, int, int], str]
     # Merge results
     merged_json = {**main_result, **nutrition_result}
 
-    if not validate_json_format(merged_json, template_path):
+    if not validate_json_format(merged_json, PROOFREADING_SCHEMA):
         raise ValueError("OCR JSON format invalid")
     return merged_json
 
@@ -286,18 +427,8 @@ def compare_jsons(docx_json: Dict, ocr_json: Dict) -> Dict:
     }
 
 
-def clean_json_string(text: str) -> str:
-    """Extract valid JSON from text"""
-    start = text.find('{')
-    end = text.rfind('}')
-    if start == -1 or end == -1:
-        raise ValueError("No valid JSON found in response")
-    return text[start:end + 1]
-
-def update_title_vailed(json_str: str) -> str:
-    """Find all 'title_vailed' keys and replace boolean values with string 'true' or 'false'"""
-    data = json.loads(json_str)
-    
+def update_title_vailed(data: Any) -> Any:
+    """Find all 'title_vailed' keys and replace boolean values with string 'true' or 'false', in place"""
     def update_values(obj):
         if isinstance(obj, dict):
             for key, value in obj.items():
@@ -310,20 +441,11 @@ def update_title_vailed(json_str: str) -> str:
                 update_values(item)
     
     update_values(data)
-    return json.dumps(data, indent=4)
-def validate_json_format(data: Dict, template_path: str) -> bool:
-    """Validate JSON against template"""
-    with open(template_path, 'r', encoding='utf-8') as f:
-        template = json.load(f)
-        
-    def validate_structure(data: Dict, template: Dict) -> bool:
-        if not isinstance(data, dict) or not isinstance(template, dict):
-            return False
-        return all(key in data and (not isinstance(value, dict) or 
-                  validate_structure(data[key], value)) 
-                  for key, value in template.items())
-    
-    return validate_structure(data, template)
+    return data
+
+def validate_json_format(data: Dict, schema_name: str) -> bool:
+    """Validate JSON against the named template"""
+    return get_templates().schema(schema_name).validate(data)
 
 if __name__ == "__main__":
     docx_path = "../AI校稿/莓果白巧瑪德蓮(單入) 莓果白巧瑪德蓮(單入) 標示說明書_114.01.03_ V.3.docx"